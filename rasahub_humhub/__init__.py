@@ -2,8 +2,9 @@ from rasahub import RasahubPlugin
 from rasahub_humhub.humhub import *
 from rasahub.message import RasahubMessage
 import mysql.connector
-from mysql.connector import errorcode
-import json
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import threading
 
 class HumhubConnector(RasahubPlugin):
     """
@@ -15,7 +16,29 @@ class HumhubConnector(RasahubPlugin):
                  port = 3306,
                  dbuser = 'user',
                  dbpasswd = '',
-                 trigger = '!bot'):
+                 trigger = '!bot',
+                 batch_size = 50,
+                 pool_min_size = 3,
+                 pool_max_size = 10,
+                 pool_timeout = 10,
+                 poll_min_interval = 0.1,
+                 poll_max_interval = 2.,
+                 send_batch_size = 0,
+                 send_flush_ms = 50,
+                 calendar_cache_ttl = 300,
+                 calendar_cache_size = 4096,
+                 calendar_workers = 8,
+                 calendar_timeout = 10,
+                 day_start = '07:00',
+                 day_end = '19:00',
+                 slot_granularity = 15,
+                 suggestion_count = 5,
+                 calendar_backend = 'google',
+                 profile_cache_size = 10000,
+                 profile_refresh_interval = 60,
+                 competence_file = 'competences.json',
+                 competence_similarity = 0.75,
+                 hold_connections = True):
         """
         Initializes database connection
 
@@ -31,21 +54,124 @@ class HumhubConnector(RasahubPlugin):
         :type state: str.
         :param trigger: trigger string for bot
         :type state: str.
+        :param batch_size: maximum number of messages fetched per poll
+        :type state: int.
+        :param pool_min_size: database connections opened on startup
+        :type state: int.
+        :param pool_max_size: maximum number of open database connections,
+                              at least 4, or 2 without held connections
+        :type state: int.
+        :param pool_timeout: seconds to wait for a free database connection
+        :type state: float.
+        :param poll_min_interval: seconds between polls while messages arrive
+        :type state: float.
+        :param poll_max_interval: upper bound in seconds for idle polling
+        :type state: float.
+        :param send_batch_size: replies saved per insert, 0 saves every reply
+                                immediately
+        :type state: int.
+        :param send_flush_ms: maximum delay of a buffered reply in milliseconds
+        :type state: int.
+        :param calendar_cache_ttl: seconds a fetched calendar day and the
+                                   kept date suggestions are reused
+        :type state: float.
+        :param calendar_cache_size: maximum number of cached calendar days
+        :type state: int.
+        :param calendar_workers: calendars fetched concurrently
+        :type state: int.
+        :param calendar_timeout: seconds to wait for the calendar fetches of
+                                 a search
+        :type state: float.
+        :param day_start: begin of working hours for appointments as HH:MM
+        :type state: str.
+        :param day_end: end of working hours for appointments as HH:MM, ends
+                        on the next day if not after day_start
+        :type state: str.
+        :param slot_granularity: appointments start at multiples of this many
+                                 minutes
+        :type state: int.
+        :param suggestion_count: free dates computed per appointment search
+                                 and kept for follow-up searches
+        :type state: int.
+        :param calendar_backend: source of busy dates, 'google' or 'humhub'
+        :type state: str.
+        :param profile_cache_size: maximum number of user names kept in memory
+        :type state: int.
+        :param profile_refresh_interval: seconds between reloads of changed
+                                         profiles and their competences
+        :type state: float.
+        :param competence_file: path to the competence taxonomy json file
+        :type state: str.
+        :param competence_similarity: minimum trigram similarity between 0 and
+                                      1 to accept a misspelled competence
+        :type state: float.
+        :param hold_connections: hold one connection each for receiving,
+                                 sending and processing, otherwise every
+                                 call borrows one from the pool
+        :type state: bool.
         """
         super(HumhubConnector, self).__init__()
 
-        self.cnx_in = connectToDB(host, dbname, port, dbuser, dbpasswd)
-        self.cursor_in = self.cnx_in.cursor()
-
-        self.cnx_out = connectToDB(host, dbname, port, dbuser, dbpasswd)
-        self.cursor_out = self.cnx_out.cursor()
+        # receiving, sending and processing each hold one pooled connection,
+        # the helpers borrow the remaining ones per call
+        minimum = 4 if hold_connections else 2
+        if int(pool_max_size) < minimum:
+            raise ValueError("pool_max_size must be at least {}, "
+                             "got {}".format(minimum, pool_max_size))
+        self.pool = ConnectionPool(host, dbname, port, dbuser, dbpasswd,
+                                   min_size = pool_min_size,
+                                   max_size = pool_max_size,
+                                   timeout = pool_timeout)
+        setConnectionPool(self.pool)
+        configureCalendarCache(calendar_cache_ttl, calendar_cache_size)
+        configureCalendarWorkers(calendar_workers, calendar_timeout)
+        configureProfileDirectory(profile_cache_size, profile_refresh_interval)
+        configureCompetenceIndex(profile_refresh_interval)
+        configureCompetences(competence_file, competence_similarity)
 
-        self.cnx_processing = connectToDB(host, dbname, port, dbuser, dbpasswd)
-        self.cursor_processing = self.cnx_processing.cursor()
+        self.cnx_in = self.cnx_out = self.cnx_processing = None
+        self.cursor_in = self.cursor_out = self.cursor_processing = None
+        if hold_connections:
+            self.cnx_in = self.pool.acquire()
+            self.cursor_in = self.cnx_in.cursor()
+            self.cnx_out = self.pool.acquire()
+            self.cursor_out = self.cnx_out.cursor()
+            self.cnx_processing = self.pool.acquire()
+            self.cursor_processing = self.cnx_processing.cursor()
+        # the held connections are checked by the pool after idling
+        self.used_at = dict((id(cnx), time()) for cnx in
+                            (self.cnx_in, self.cnx_out, self.cnx_processing)
+                            if cnx is not None)
+        self.reply_buffer = None
+        if int(send_batch_size) > 1:
+            self.reply_buffer = WriteBehindBuffer(self.cnx_out,
+                                                  send_batch_size,
+                                                  send_flush_ms,
+                                                  self.pool)
 
         self.trigger = trigger
-        self.current_id = getCurrentID(self.cursor_in)
-        self.bot_id = getBotID(self.cursor_in)
+        self.day_start = datetime.strptime(day_start, '%H:%M').time()
+        self.day_end = datetime.strptime(day_end, '%H:%M').time()
+        self.slot_granularity = int(slot_granularity)
+        self.suggestion_count = max(int(suggestion_count), 1)
+        self.calendar_backend = getCalendarBackend(calendar_backend)
+        self.suggestion_conversations = 256
+        self.suggestion_ttl = calendar_cache_ttl
+        self.suggestions = OrderedDict()
+        self.suggestions_lock = threading.Lock()
+        self.batch_size = max(int(batch_size), 1)
+        self.pending = deque()
+        self.scheduler = PollScheduler(poll_min_interval, poll_max_interval)
+        with self.use_cursor('in') as cursor:
+            self.current_id = getCurrentID(cursor)
+            self.bot_id = getBotID(cursor)
+            # membership index of conversations the bot takes part in,
+            # scanned messages of other conversations are looked up again,
+            # as the bot may have joined them since
+            self.conversations = getBotConversations(cursor, self.bot_id)
+        # message entries up to scan_id have been looked at, current_id is
+        # the last one handed out
+        self.scan_id = self.current_id
 
 
     def send(self, messagedata, main_queue):
@@ -55,23 +181,19 @@ class HumhubConnector(RasahubPlugin):
         :param messagedata: Containing the reply from Rasa as string and the conversation id
         :type state: dictionary.
         """
-        query = ("INSERT INTO message_entry(message_id, user_id, content, created_at, created_by, updated_at, updated_by) "
-            "VALUES (%(msg_id)s, %(bot_id)s, %(message)s, NOW(), %(bot_id)s, NOW(), %(bot_id)s)")
-        data = {
-          'msg_id': messagedata.message_id,
-          'bot_id': self.bot_id,
-          'message': messagedata.message,
-        }
+        if self.reply_buffer is not None:
+            self.reply_buffer.add(messagedata.message_id,
+                                  self.bot_id,
+                                  messagedata.message)
+            return
+        query, data = replyQuery(messagedata.message_id,
+                                 self.bot_id,
+                                 messagedata.message)
         try:
-            self.cursor_out.execute(query, data)
-            self.cnx_out.commit()
+            with self.use_cursor('out') as cursor:
+                cursor.execute(query, data) # connection autocommits
         except mysql.connector.Error as err:
-            if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
-                print("Something is wrong with your user name or password")
-            elif err.errno == errorcode.ER_BAD_DB_ERROR:
-                print("Database does not exist")
-            else:
-                print(err)
+            printDBError(err)
 
     def receive(self):
         """
@@ -79,22 +201,115 @@ class HumhubConnector(RasahubPlugin):
 
         :returns: dictionary - Received message with conversation ID
         """
-        new_id = getNextID(self.cursor_in, self.current_id, self.bot_id, self.trigger)
-        if (self.current_id != new_id): # new messages
-            self.current_id = new_id
-            inputmsg = getMessage(self.cursor_in, new_id, self.trigger)
-            return inputmsg
+        # rasahub calls receive in a loop without pause, so wait for the
+        # next poll instead of returning at once
+        if not self.pending and self.scheduler.wait():
+            # drain all new messages with one query
+            query, data = scanMessagesQuery(self.scan_id,
+                                            self.bot_id,
+                                            self.batch_size)
+            with self.use_cursor('in') as cursor:
+                cursor.execute(query, data)
+                rows = cursor.fetchall()
+                unknown = self.unknown_conversations(rows)
+                if unknown:
+                    query, data = botConversationsQuery(self.bot_id, unknown)
+                    cursor.execute(query, data)
+                    self.add_conversations(cursor.fetchall())
+            self.add_pending(rows)
+        return self.next_pending()
+
+    def unknown_conversations(self, rows):
+        """
+        Returns the conversations of scanned rows missing in the membership
+        index
+
+        :returns: list - conversation IDs to look up in user_message
+        """
+        return sorted(set(row[1] for row in rows
+                          if row[1] not in self.conversations))
+
+    def add_conversations(self, conversation_rows):
+        """
+        Adds looked up bot conversations to the membership index
+        """
+        self.conversations.update(row[0] for row in conversation_rows)
+
+    def add_pending(self, rows):
+        """
+        Queues scanned rows addressed to the bot and advances scan_id
+        """
+        self.scheduler.record(len(rows))
+        if rows:
+            self.scan_id = rows[-1][0]
+            self.pending.extend(
+                filterMessages(rows, self.trigger, self.conversations))
+
+    def next_pending(self):
+        """
+        Hands out the oldest fetched message and advances current_id
+
+        :returns: dictionary - Received message with conversation ID
+        """
+        if self.pending:
+            inputmsg = self.pending.popleft()
+            self.current_id = inputmsg['id']
+            return {
+                'message': inputmsg['message'],
+                'message_id': inputmsg['message_id']
+            }
 
     def process_command(self, command, payload, out_message):
         """
         Returns message object
         """
+        with self.use_cursor('processing') as cursor:
+            return self.run_command(command, payload, cursor)
+
+    @contextmanager
+    def use_cursor(self, name):
+        """
+        Yields the checked cursor of the held connection for receiving
+        ('in'), sending ('out') or 'processing', or a cursor of a connection
+        borrowed for the with block if no connections are held
+        """
+        cnx = getattr(self, 'cnx_' + name)
+        if cnx is not None:
+            cursor = self.checked_cursor(cnx, getattr(self, 'cursor_' + name))
+            setattr(self, 'cursor_' + name, cursor)
+            yield cursor
+            return
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def checked_cursor(self, cnx, cursor):
+        """
+        Returns a usable cursor of a connection held for the connector's
+        lifetime, the connection is reconnected if it broke while idling
+
+        :returns: MySQLCursor - the given cursor or one of the reconnection
+        """
+        if self.pool.refresh(cnx, self.used_at.get(id(cnx), 0)):
+            cursor = cnx.cursor()
+        self.used_at[id(cnx)] = time()
+        return cursor
+
+    def run_command(self, command, payload, cursor):
+        """
+        Executes a command using the given cursor
+
+        :returns: RasahubMessage - reply to the command
+        """
         if command == "search_appointment":
-            reply = self.search_appointment(payload, self.cursor_processing)
+            reply = self.search_appointment(payload, cursor)
         elif command == "book_appointment":
-            reply = self.book_appointment(payload, self.cursor_processing)
+            reply = self.book_appointment(payload, cursor)
         elif command == "search_competence":
-            reply = self.get_competence(payload, self.cursor_processing)
+            reply = self.get_competence(payload, cursor)
         else:
             reply = RasahubMessage(
                 message = "Command unknown",
@@ -115,31 +330,9 @@ class HumhubConnector(RasahubPlugin):
         # search available dates between preferred
         #
         # search date after current time
-        beginHour = 7
-        beginMinuteIndex = 0
-        endHour = 19
-        endHourIndex = 3
-        if payload['args']['datefrom']:
-            searchDateFrom = datetime.strptime(payload['args']['datefrom'],
-                                               '%Y-%m-%dT%H:%M:%S.000Z')
-            if searchDateFrom.date() == datetime.now().date():
-                beginHour = datetime.now().hour
-                beginMinuteIndex = int(
-                    math.ceil(float(datetime.now().minute) / 15.))
-
+        duration = payload['args']['duration'] or self.slot_granularity
         try:
-            suggestedDate = suggestDate(
-                payload['args']['datefrom'],
-                payload['args']['dateto'],
-                payload['args']['duration'],
-                payload['args']['users'],
-                payload['args']['timesSearched'],
-                beginHour,
-                beginMinuteIndex,
-                endHour,
-                endHourIndex,
-                cursor
-            )
+            suggestedDates = self.get_suggestions(payload, duration, cursor)
 
             reply = {}
 
@@ -151,13 +344,10 @@ class HumhubConnector(RasahubPlugin):
             #    source = payload['message_target']
             #)
             msg = ""
-            if (suggestedDate is not None and
-                suggestedDate[0] is not None and
-                suggestedDate[1] is not None):
-                suggestedDate = searchDateFrom.replace(
-                    hour=suggestedDate[0], minute=suggestedDate[1])
+            if len(suggestedDates) > 0:
+                suggestedDate = suggestedDates[0]
                 # get end time
-                suggestedDateTo = getEndTime(suggestedDate, payload['args']['duration'])
+                suggestedDateTo = suggestedDate + timedelta(minutes=duration)
                 msg = "Am {} gibt es zwischen {} und {} Uhr einen freien Termin."
                 msg = msg.format(
                     suggestedDate.strftime("%A, den %d.%m.%Y"),
@@ -177,6 +367,68 @@ class HumhubConnector(RasahubPlugin):
         except:
             return None # auth exception, no message to process anymore
 
+    def get_suggestions(self, payload, duration, cursor):
+        """
+        Gets the free date for the n-th search in a conversation. The first
+        search computes suggestion_count dates at once and keeps them by
+        conversation, following searches for another date are answered from
+        them. Searches past the kept dates compute the next suggestion_count
+        dates. Kept dates expire with the calendar cache and dates already
+        passed are skipped.
+
+        :returns: list - containing the free date or empty
+        """
+        timesSearched = payload['args']['timesSearched'] or 0
+        search = (payload['args']['datefrom'],
+                  payload['args']['dateto'],
+                  duration,
+                  tuple(payload['args']['users']))
+        now = datetime.now()
+        with self.suggestions_lock:
+            suggestions = self.suggestions.pop(payload['message_id'], None)
+        if suggestions is not None and (suggestions['search'] != search or
+                                        suggestions['expires'] < time()):
+            suggestions = None
+        index = timesSearched
+        if suggestions is not None:
+            # dates are sorted, those passed by now form a prefix
+            while suggestions['dates'] and suggestions['dates'][0] < now:
+                suggestions['dates'].pop(0)
+                suggestions['passed'] += 1
+            index = max(timesSearched - suggestions['passed'], 0)
+        if (suggestions is None or
+                (index >= len(suggestions['dates']) and
+                 not suggestions['complete'])):
+            count = timesSearched + self.suggestion_count
+            dates = suggestSlots(
+                max(datetime.strptime(payload['args']['datefrom'],
+                                      '%Y-%m-%dT%H:%M:%S.000Z'),
+                    now),
+                datetime.strptime(payload['args']['dateto'],
+                                  '%Y-%m-%dT%H:%M:%S.000Z'),
+                duration,
+                payload['args']['users'],
+                cursor,
+                self.day_start,
+                self.day_end,
+                self.slot_granularity,
+                count,
+                backend = self.calendar_backend
+            )
+            suggestions = {
+                'search': search,
+                'dates': dates,
+                'passed': 0,
+                'complete': len(dates) < count,
+                'expires': time() + self.suggestion_ttl,
+            }
+            index = timesSearched
+        with self.suggestions_lock:
+            self.suggestions[payload['message_id']] = suggestions
+            while len(self.suggestions) > self.suggestion_conversations:
+                self.suggestions.popitem(last=False)
+        return suggestions['dates'][index:index + 1]
+
     def book_appointment(self, payload, cursor):
         """
         Books a appointment in Users Google calendars
@@ -188,8 +440,7 @@ class HumhubConnector(RasahubPlugin):
         """
         Returns user with searched competence
         """
-        with open('competences.json') as data_file:
-            data = json.load(data_file)
+        data = getCompetences()
         try:
             s = dict((i['entity'], i['value'])
                      for i in payload['args']['entities'])
@@ -210,15 +461,13 @@ class HumhubConnector(RasahubPlugin):
                 categories.append(searchCompetence(search, data))
 
             exceptUserIDs = getUsersInConversation(cursor, payload['message_id'], self.bot_id)
-            usercompetencies = getUserCompetencies(cursor, exceptUserIDs)
 
             # get users matching competences
             matchingUsers = []
             for category in categories:
-                if (getUsersWithCompetencies(category, usercompetencies) is not None):
-                    matchingUsers.append(
-                        getUsersWithCompetencies(category, usercompetencies)
-                    )
+                users = findCompetentUsers(category, exceptUserIDs)
+                if users is not None:
+                    matchingUsers.append(users)
             if matchingUsers is None or len(matchingUsers) == 0:
                 resMsg = "Keinen Ansprechpartner gefunden."
             else:
@@ -247,13 +496,20 @@ class HumhubConnector(RasahubPlugin):
 
         except ValueError:
             resMsg = "Keinen Ansprechpartner gefunden."
-        dispatcher.utter_message(resMsg)
-        return []
+        return RasahubMessage(
+            message = resMsg,
+            message_id = payload['message_id'],
+            target = payload['message_target'],
+            source = payload['message_source']
+        )
 
     def end(self):
         """
-        Closed mysql connections
+        Flushes buffered replies and closes mysql connections
         """
-        self.cnx_in.close()
-        self.cnx_out.close()
-        self.cnx_processing.close()
+        if self.reply_buffer is not None:
+            self.reply_buffer.close()
+        for cnx in (self.cnx_in, self.cnx_out, self.cnx_processing):
+            if cnx is not None:
+                self.pool.release(cnx)
+        self.pool.close()
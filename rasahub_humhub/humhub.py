@@ -3,26 +3,47 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from datetime import datetime
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 # import rasahub_google_calendar
-from time import gmtime, time, strftime
+from time import gmtime, sleep, time, strftime
+import bisect
 import json
 import locale
 import logging
 import math
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import mysql.connector
 from mysql.connector import errorcode
 import os
 import string
-import random
 import re
+import threading
+import uuid
 import yaml
 from nltk.stem.snowball import SnowballStemmer
 import httplib2
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-stemmer = SnowballStemmer("german")
 logger = logging.getLogger(__name__)
 offlinemode = False
+connectionPool = None
+# calendars are matched on a grid of 15 minute slots, a day is a bitmask with
+# bit hour * 4 + quarter set for busy slots
+SLOTS_PER_HOUR = 4
+SLOTS_PER_DAY = 24 * SLOTS_PER_HOUR
+FULL_DAY = (1 << SLOTS_PER_DAY) - 1
+# shorter competence searches share too few trigrams to tell typos apart
+MIN_SIMILAR_LENGTH = 4
 locale.setlocale(locale.LC_ALL, "de_DE.utf8")
 
 
@@ -31,11 +52,41 @@ class NotAuthenticatedError(Exception):
     Class NotAuthenticatedError is thrown everytime a google user is not
     authenticated properly.
     """
-    def __init__(self):
+    def __init__(self, users=None):
         """
         Exception initialization, sets error message.
+
+        :param users: Humhub User IDs not authenticated
+        :type users: list
         """
+        self.users = users or []
         self.msg = "Not Authenticated"
+        if self.users:
+            self.msg += ": " + ", ".join(str(user) for user in self.users)
+    def __str__(self):
+        """
+        to-String method
+
+        :return: Error message
+        :rtype: str
+        """
+        return self.msg
+
+class CalendarTimeoutError(Exception):
+    """
+    Class CalendarTimeoutError is thrown when calendars could not be fetched
+    in time.
+    """
+    def __init__(self, users):
+        """
+        Exception initialization, sets error message.
+
+        :param users: Humhub User IDs whose calendar fetch timed out
+        :type users: list
+        """
+        self.users = users
+        self.msg = "Calendar fetch timed out: " + ", ".join(
+            str(user) for user in users)
     def __str__(self):
         """
         to-String method
@@ -65,15 +116,704 @@ def connectToDB(dbHost, dbName, dbPort, dbUser, dbPwd):
     try:
         cnx = mysql.connector.connect(user=dbUser, port=int(dbPort), password=dbPwd, host=dbHost, database=dbName, autocommit=True)
     except mysql.connector.Error as err:
-        if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
-            print("Something is wrong with your user name or password")
-        elif err.errno == errorcode.ER_BAD_DB_ERROR:
-            print("Database does not exist")
-        else:
-            print(err)
+        printDBError(err)
+    else:
+        return cnx
+
+def printDBError(err):
+    """
+    Prints a readable message for a database error
+
+    :param err: Error raised by mysql.connector
+    :type err: mysql.connector.Error
+    """
+    if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
+        print("Something is wrong with your user name or password")
+    elif err.errno == errorcode.ER_BAD_DB_ERROR:
+        print("Database does not exist")
     else:
+        print(err)
+
+
+class PoolTimeoutError(Exception):
+    """
+    Class PoolTimeoutError is thrown when no database connection could be
+    checked out of the connection pool in time.
+    """
+    def __init__(self, timeout):
+        """
+        Exception initialization, sets error message.
+        """
+        self.msg = "No database connection available after {} seconds".format(
+            timeout)
+    def __str__(self):
+        """
+        to-String method
+
+        :return: Error message
+        :rtype: str
+        """
+        return self.msg
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of Humhub database connections shared by the connector and
+    the module-level helpers
+    """
+    def __init__(self,
+                 host = '127.0.0.1',
+                 dbname = 'humhub',
+                 port = 3306,
+                 dbuser = 'user',
+                 dbpasswd = '',
+                 min_size = 3,
+                 max_size = 10,
+                 timeout = 10,
+                 health_check_interval = 30):
+        """
+        Initializes the pool and opens min_size connections
+
+        :param host: database host address
+        :type host: str
+        :param dbname: database name
+        :type dbname: str
+        :param port: database host port
+        :type port: int
+        :param dbuser: database username
+        :type dbuser: str
+        :param dbpasswd: database userpassword
+        :type dbpasswd: str
+        :param min_size: Number of connections opened on startup
+        :type min_size: int
+        :param max_size: Maximum number of open connections
+        :type max_size: int
+        :param timeout: Seconds to wait for a free connection on checkout
+        :type timeout: float
+        :param health_check_interval: Connections idle for longer than this
+                                      many seconds are pinged before checkout
+        :type health_check_interval: float
+        """
+        self.dbargs = (host, dbname, port, dbuser, dbpasswd)
+        self.max_size = max(int(max_size), 1)
+        self.min_size = min(max(int(min_size), 0), self.max_size)
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.size = 0
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        for i in range(self.min_size):
+            self.idle.put((self.create(), time()))
+
+    def create(self):
+        """
+        Opens a new connection and counts it against max_size
+
+        :return: Instance of class MySQLConnection
+        :rtype: MySQLConnection
+        """
+        with self.lock:
+            if self.size >= self.max_size:
+                return None
+            self.size += 1
+        cnx = connectToDB(*self.dbargs)
+        if cnx is None:
+            with self.lock:
+                self.size -= 1
+            raise mysql.connector.Error("Could not connect to database")
         return cnx
 
+    def discard(self, cnx):
+        """
+        Closes a broken connection and frees its slot
+        """
+        with self.lock:
+            self.size -= 1
+        try:
+            cnx.close()
+        except mysql.connector.Error:
+            pass
+
+    def acquire(self, timeout=None):
+        """
+        Checks out a healthy connection, waits up to timeout seconds if the
+        pool is exhausted
+
+        :param timeout: Seconds to wait, defaults to the pool timeout
+        :type timeout: float
+        :return: Instance of class MySQLConnection
+        :rtype: MySQLConnection
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time() + timeout
+        while True:
+            try:
+                cnx, released_at = self.idle.get_nowait()
+            except queue.Empty:
+                cnx = self.create()
+                if cnx is not None:
+                    return cnx
+                try:
+                    cnx, released_at = self.idle.get(
+                        timeout=max(deadline - time(), 0))
+                except queue.Empty:
+                    raise PoolTimeoutError(timeout)
+            if (time() - released_at < self.health_check_interval or
+                    cnx.is_connected()):
+                return cnx
+            logger.warning("Discarding broken database connection")
+            self.discard(cnx)
+
+    def refresh(self, cnx, used_at):
+        """
+        Checks a connection held outside the pool before it is used again.
+        Connections unused for health_check_interval seconds are pinged and
+        reconnected if the server closed them.
+
+        :param cnx: Connection held by the caller
+        :type cnx: MySQLConnection
+        :param used_at: Time the connection was used last
+        :type used_at: float
+        :return: True if the connection was reconnected, its old cursors
+                 must not be used anymore
+        :rtype: bool
+        """
+        if (time() - used_at < self.health_check_interval or
+                cnx.is_connected()):
+            return False
+        logger.warning("Reconnecting broken database connection")
+        cnx.reconnect()
+        return True
+
+    def release(self, cnx):
+        """
+        Returns a connection to the pool
+        """
+        self.idle.put((cnx, time()))
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Borrows a connection for the duration of a with block
+        """
+        cnx = self.acquire(timeout)
+        try:
+            yield cnx
+        finally:
+            self.release(cnx)
+
+    def close(self):
+        """
+        Closes all idle connections
+        """
+        while True:
+            try:
+                cnx, released_at = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(cnx)
+
+
+class PollScheduler(object):
+    """
+    Decides when the connector polls Humhub for new messages. Polls back off
+    exponentially while idle and happen immediately after a non-empty batch.
+    """
+    def __init__(self, min_interval=0.1, max_interval=2., backoff=2.):
+        """
+        Initializes the scheduler and its counters
+
+        :param min_interval: Seconds between polls while messages arrive
+        :type min_interval: float
+        :param max_interval: Upper bound in seconds for the idle interval
+        :type max_interval: float
+        :param backoff: Factor the interval grows by after each empty poll
+        :type backoff: float
+        """
+        self.min_interval = float(min_interval)
+        self.max_interval = max(float(max_interval), self.min_interval)
+        self.backoff = max(float(backoff), 1.)
+        self.interval = self.min_interval
+        self.next_poll = 0.
+        self.polls = 0
+        self.empty_polls = 0
+        self.rows = 0
+        self.last_rows = 0
+
+    def due(self, now=None):
+        """
+        Checks if the next poll is due
+
+        :rtype: bool
+        """
+        if now is None:
+            now = time()
+        return now >= self.next_poll
+
+    def delay(self, max_wait=0.5, now=None):
+        """
+        Returns the seconds until the next poll is due
+
+        :param max_wait: Upper bound of the delay, keeps callers responsive
+                         to shutdown
+        :type max_wait: float
+        :rtype: float
+        """
+        if now is None:
+            now = time()
+        return min(max(self.next_poll - now, 0.), max_wait)
+
+    def wait(self, max_wait=0.5):
+        """
+        Sleeps until the next poll is due, at most max_wait seconds
+
+        :return: True if the next poll is due
+        :rtype: bool
+        """
+        sleep(self.delay(max_wait))
+        return self.due()
+
+    def record(self, rows, now=None):
+        """
+        Records the result of a poll and schedules the next one
+
+        :param rows: Number of rows the poll returned
+        :type rows: int
+        """
+        if now is None:
+            now = time()
+        self.polls += 1
+        self.rows += rows
+        self.last_rows = rows
+        if rows > 0:
+            self.interval = self.min_interval
+            self.next_poll = now
+        else:
+            self.empty_polls += 1
+            self.next_poll = now + self.interval
+            self.interval = min(self.interval * self.backoff,
+                                self.max_interval)
+
+    def stats(self):
+        """
+        Returns the poll counters
+
+        :return: Polls, empty polls, rows overall, rows per poll and the
+                 current idle interval
+        :rtype: dict
+        """
+        return {
+            'polls': self.polls,
+            'empty_polls': self.empty_polls,
+            'rows': self.rows,
+            'last_rows': self.last_rows,
+            'rows_per_poll': float(self.rows) / self.polls if self.polls else 0.,
+            'interval': self.interval,
+        }
+
+
+class WriteBehindBuffer(object):
+    """
+    Collects bot replies and saves them with multi-row inserts. Replies are
+    written in the order they were added, so every conversation keeps its
+    order. A flush happens when max_rows replies are pending or flush_ms
+    milliseconds after the first pending reply. Replies of a failed flush
+    stay pending and are saved again after retry_delay seconds.
+    """
+    retry_delay = 1.
+
+    def __init__(self, cnx, max_rows=20, flush_ms=50, pool=None):
+        """
+        Initializes the buffer, the flush thread starts with the first reply
+
+        :param cnx: Connection used to save the replies, None borrows one
+                    from pool for every flush
+        :type cnx: MySQLConnection
+        :param max_rows: Number of pending replies triggering a flush
+        :type max_rows: int
+        :param flush_ms: Maximum delay of a reply in milliseconds
+        :type flush_ms: int
+        :param pool: Pool the connection belongs to, checks the connection
+                     before a flush after idling
+        :type pool: ConnectionPool
+        """
+        self.cnx = cnx
+        self.pool = pool
+        self.used_at = time()
+        self.max_rows = max(int(max_rows), 1)
+        self.flush_delay = float(flush_ms) / 1000.
+        self.rows = []
+        self.deadline = None
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+        self.failing = False
+
+    def add(self, message_id, bot_id, message):
+        """
+        Queues a reply for the conversation message_id
+        """
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.rows.append((message_id, bot_id, message, bot_id, bot_id))
+            if len(self.rows) >= self.max_rows and not self.failing:
+                self.flush_rows()
+            elif self.deadline is None:
+                self.deadline = time() + self.flush_delay
+                self.condition.notify()
+
+    def run(self):
+        """
+        Flushes pending replies when their deadline is reached
+        """
+        with self.condition:
+            while not self.closed:
+                if self.deadline is None:
+                    self.condition.wait()
+                elif self.deadline > time():
+                    self.condition.wait(self.deadline - time())
+                else:
+                    self.flush_rows()
+
+    def flush(self):
+        """
+        Saves all pending replies synchronously
+
+        :return: False if saving failed and the replies are still pending
+        :rtype: bool
+        """
+        with self.condition:
+            return self.flush_rows()
+
+    def flush_rows(self):
+        """
+        Saves pending replies, the caller holds the condition lock
+
+        :return: False if saving failed and the replies are still pending
+        :rtype: bool
+        """
+        self.deadline = None
+        if len(self.rows) == 0:
+            return True
+        query = ("INSERT INTO message_entry(message_id, user_id, content, created_at, created_by, updated_at, updated_by) "
+            "VALUES (%s, %s, %s, NOW(), %s, NOW(), %s)")
+        try:
+            if self.cnx is None:
+                with self.pool.connection() as cnx:
+                    cursor = cnx.cursor()
+                    cursor.executemany(query, self.rows)
+                    cursor.close()
+            else:
+                if self.pool is not None:
+                    self.pool.refresh(self.cnx, self.used_at)
+                self.used_at = time()
+                cursor = self.cnx.cursor()
+                cursor.executemany(query, self.rows)
+                cursor.close()
+        except (mysql.connector.Error, PoolTimeoutError) as err:
+            if isinstance(err, mysql.connector.Error):
+                printDBError(err)
+            logger.warning("Saving %d replies failed, retrying in %s seconds",
+                           len(self.rows), self.retry_delay)
+            self.failing = True
+            self.deadline = time() + self.retry_delay
+            return False
+        self.rows = []
+        self.failing = False
+        return True
+
+    def close(self):
+        """
+        Flushes pending replies and stops the flush thread
+        """
+        with self.condition:
+            if not self.flush_rows():
+                logger.error("Dropping %d unsaved replies", len(self.rows))
+                self.rows = []
+                self.deadline = None
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class CalendarCache(object):
+    """
+    Process-wide cache of appointment intervals keyed by user ID and day.
+    Entries expire after ttl seconds, the least recently used entry is evicted
+    when maxsize entries are stored.
+    """
+    def __init__(self, ttl=300, maxsize=4096):
+        """
+        Initializes the empty cache
+
+        :param ttl: Seconds a calendar day stays valid
+        :type ttl: float
+        :param maxsize: Maximum number of cached user days
+        :type maxsize: int
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, day):
+        """
+        Gets the cached appointments of a user day
+
+        :return: Tuple of (start, end) datetimes or None if not cached or
+                 expired
+        :rtype: tuple
+        """
+        key = (user_id, day)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] < time():
+                self.misses += 1
+                return None
+            self.entries[key] = entry # mark as recently used
+            self.hits += 1
+            return entry[0]
+
+    def put(self, user_id, day, intervals):
+        """
+        Caches the appointments of a user day
+
+        :param intervals: Tuple of (start, end) datetimes
+        :type intervals: tuple
+        """
+        key = (user_id, day)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (intervals, time() + self.ttl)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """
+        Removes all cached days of a user, e.g. after booking an appointment
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == user_id]:
+                del self.entries[key]
+
+    def clear(self):
+        """
+        Removes all cached days
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Returns the cache counters
+
+        :return: Hits, misses and number of cached user days
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries),
+            }
+
+
+calendarCache = CalendarCache()
+calendarWorkers = None
+calendarWorkersLock = threading.Lock()
+calendarFetches = {}
+calendarWorkerCount = 8
+calendarTimeout = 10
+
+
+def configureCalendarCache(ttl, maxsize):
+    """
+    Sets expiry and size bound of the calendar cache
+
+    :param ttl: Seconds a calendar day stays valid
+    :type ttl: float
+    :param maxsize: Maximum number of cached user days
+    :type maxsize: int
+    """
+    calendarCache.ttl = ttl
+    calendarCache.maxsize = maxsize
+
+
+class ProfileDirectory(object):
+    """
+    In-process directory of Humhub user names. Profiles are bulk loaded once,
+    then refreshed incrementally by updated_at. At most maxsize profiles are
+    kept, the least recently used are evicted first.
+    """
+    def __init__(self, maxsize=10000, refresh_interval=60):
+        """
+        Initializes the empty directory
+
+        :param maxsize: Maximum number of profiles kept
+        :type maxsize: int
+        :param refresh_interval: Seconds between refreshes from the database
+        :type refresh_interval: float
+        """
+        self.maxsize = maxsize
+        self.refresh_interval = refresh_interval
+        self.names = OrderedDict()
+        self.fullNames = {}
+        self.lastNames = {}
+        self.updated = None
+        self.refreshed = None
+        self.lock = threading.RLock()
+
+    def refresh(self, cnx, force=False):
+        """
+        Loads all profiles on first use, afterwards only profiles changed
+        since the last refresh
+
+        :param cnx: Connection to read profiles with
+        :type cnx: MySQLConnection
+        :param force: Refresh even if the refresh interval did not pass
+        :type force: bool
+        """
+        with self.lock:
+            if (not force and self.refreshed is not None and
+                    time() - self.refreshed < self.refresh_interval):
+                return
+            cursor = cnx.cursor()
+            if self.refreshed is None:
+                query = ("""SELECT user_id, firstname, lastname, updated_at
+                         FROM profile ORDER BY updated_at DESC LIMIT %s""")
+                cursor.execute(query, (self.maxsize,))
+                rows = list(reversed(cursor.fetchall()))
+            else:
+                # updated_at has second resolution, profiles saved later in
+                # the second of the watermark are read again
+                query = ("""SELECT user_id, firstname, lastname, updated_at
+                         FROM profile WHERE updated_at >= %s
+                         ORDER BY updated_at ASC""")
+                cursor.execute(query, (self.updated,))
+                rows = cursor.fetchall()
+            cursor.close()
+            for (user_id, firstname, lastname, updated_at) in rows:
+                self.add(user_id, firstname, lastname)
+                if updated_at is not None and (self.updated is None or
+                                               updated_at > self.updated):
+                    self.updated = updated_at
+            self.refreshed = time()
+
+    def add(self, user_id, firstname, lastname):
+        """
+        Adds or updates a profile
+        """
+        with self.lock:
+            self.remove(user_id)
+            firstname = firstname or ''
+            lastname = lastname or ''
+            self.names[user_id] = (firstname, lastname)
+            self.fullNames[(firstname.lower(), lastname.lower())] = user_id
+            self.lastNames[lastname.lower()] = user_id
+            while len(self.names) > self.maxsize:
+                self.remove(next(iter(self.names)))
+
+    def remove(self, user_id):
+        """
+        Removes a profile and its name index entries
+        """
+        with self.lock:
+            if user_id not in self.names:
+                return
+            firstname, lastname = self.names.pop(user_id)
+            fullName = (firstname.lower(), lastname.lower())
+            if self.fullNames.get(fullName) == user_id:
+                del self.fullNames[fullName]
+            if self.lastNames.get(lastname.lower()) == user_id:
+                del self.lastNames[lastname.lower()]
+
+    def getName(self, cnx, user_id):
+        """
+        Gets users firstname and lastname by user_id
+
+        :return: Full username or empty string for unknown users
+        :rtype: str
+        """
+        self.refresh(cnx)
+        with self.lock:
+            if user_id not in self.names:
+                cursor = cnx.cursor()
+                query = ("""SELECT firstname, lastname FROM profile
+                         WHERE user_id = %s""")
+                cursor.execute(query, (user_id,))
+                rows = cursor.fetchall()
+                cursor.close()
+                if len(rows) == 0:
+                    return ''
+                self.add(user_id, rows[-1][0], rows[-1][1])
+            firstname, lastname = self.names.pop(user_id)
+            self.names[user_id] = (firstname, lastname) # recently used
+        return firstname + " " + lastname
+
+    def getID(self, cnx, firstname, lastname):
+        """
+        Gets the user ID by lastname or by firstname and lastname
+
+        :return: Humhub User ID or None for unknown names
+        :rtype: int
+        """
+        self.refresh(cnx)
+        with self.lock:
+            if firstname == '':
+                user_id = self.lastNames.get(lastname.lower())
+            else:
+                user_id = self.fullNames.get(
+                    (firstname.lower(), lastname.lower()))
+            if user_id is not None:
+                return user_id
+            cursor = cnx.cursor()
+            if firstname == '':
+                query = ("""SELECT user_id, firstname, lastname FROM profile
+                         WHERE lastname = %s""")
+                cursor.execute(query, (lastname,))
+            else:
+                query = ("""SELECT user_id, firstname, lastname FROM profile
+                         WHERE firstname = %s AND lastname = %s""")
+                cursor.execute(query, (firstname, lastname))
+            for (user_id, first, last) in cursor.fetchall():
+                self.add(user_id, first, last)
+            cursor.close()
+            return user_id
+
+
+profileDirectory = ProfileDirectory()
+
+
+def configureProfileDirectory(maxsize, refresh_interval):
+    """
+    Sets size bound and refresh interval of the profile directory
+
+    :param maxsize: Maximum number of profiles kept
+    :type maxsize: int
+    :param refresh_interval: Seconds between refreshes from the database
+    :type refresh_interval: float
+    """
+    profileDirectory.maxsize = maxsize
+    profileDirectory.refresh_interval = refresh_interval
+
+
+def setConnectionPool(pool):
+    """
+    Sets the connection pool used by the module-level helpers
+
+    :param pool: Connection pool to borrow connections from
+    :type pool: ConnectionPool
+    """
+    global connectionPool
+    connectionPool = pool
+
 def getBotID(cursor):
     """
     Gets a suitable Bot User ID from a Humhub User Group called 'Bots'
@@ -85,49 +825,125 @@ def getBotID(cursor):
     cursor.execute(query)
     return cursor.fetchone()[0]
 
-def getNextID(cursor, current_id, bot_id, trigger):
+def scanMessagesQuery(current_id, bot_id, limit=50):
     """
-    Gets the next message ID from Humhub
+    Builds the range scan over message_entry used together with the cached
+    set of bot conversations
 
-    :return: Next message ID to process
-    :rtype: int
+    :return: Query string and its parameters
+    :rtype: tuple
     """
-    query = ("SELECT id FROM message_entry WHERE user_id <> %(bot_id)s AND (content LIKE %(trigger)s OR message_entry.message_id IN "
-        "(SELECT DISTINCT message_entry.message_id FROM message_entry JOIN user_message "
-        "ON message_entry.message_id=user_message.message_id WHERE user_message.user_id = 5 ORDER BY message_entry.message_id)) "
-        "AND id > %(current_id)s ORDER BY id ASC")
+    query = ("SELECT id, message_id, user_id, content FROM message_entry "
+        "WHERE id > %(current_id)s AND user_id <> %(bot_id)s ORDER BY id ASC LIMIT %(limit)s")
     data = {
         'bot_id': bot_id,
-        'trigger': trigger + '%', # wildcard for SQL
         'current_id': current_id,
+        'limit': int(limit),
     }
-    row_count = cursor.execute(query, data)
-    results = cursor.fetchall()
-    if len(results) > 0: # fetchall returns list of results, each as a tuple
-        return results[0][0]
-    else:
-        return current_id
+    return query, data
 
-def getMessage(cursor, msg_id, trigger):
+def botConversationsQuery(bot_id, message_ids=None):
     """
-    Gets the newest message
+    Builds the statement loading conversation IDs the bot participates in
 
-    :returns: Containing the message itself as string and the conversation ID
-    :rtype: dict
+    :param bot_id: Bot Humhub User ID
+    :type bot_id: int
+    :param message_ids: Only check these conversations, all if None
+    :type message_ids: list
+    :return: Query string and its parameters
+    :rtype: tuple
     """
-    query = "SELECT message_id, content FROM message_entry WHERE (user_id <> 5 AND id = {})".format(msg_id)
-    cursor.execute(query)
-    result = cursor.fetchone()
-    message_id = result[0]
-    if result[1][:len(trigger)] == trigger:
-        message = result[1][len(trigger):].strip()
-    else:
-        message = result[1].strip()
-    messagedata = {
-        'message': message,
-        'message_id': message_id
+    query = "SELECT message_id FROM user_message WHERE user_id = %s"
+    data = [bot_id]
+    if message_ids is not None:
+        message_ids = list(message_ids)
+        query += " AND message_id IN ({})".format(
+            ', '.join('%s' for unused in message_ids))
+        data.extend(message_ids)
+    return query, tuple(data)
+
+def getBotConversations(cursor, bot_id, message_ids=None):
+    """
+    Gets the IDs of the conversations the bot participates in
+
+    :param message_ids: Only check these conversations, all if None
+    :type message_ids: list
+    :return: Conversation IDs
+    :rtype: set
+    """
+    query, data = botConversationsQuery(bot_id, message_ids)
+    cursor.execute(query, data)
+    return set(row[0] for row in cursor.fetchall())
+
+def filterMessages(rows, trigger, conversations):
+    """
+    Keeps rows starting with the trigger or belonging to a bot conversation
+
+    :param rows: Rows of id, message_id, user_id and content
+    :type rows: list
+    :param trigger: trigger string for bot
+    :type trigger: str
+    :param conversations: Conversation IDs the bot participates in
+    :type conversations: set
+    :return: Messages in id order
+    :rtype: list
+    """
+    return parseMessages(
+        [row for row in rows
+         if row[1] in conversations or row[3][:len(trigger)] == trigger],
+        trigger)
+
+def parseMessages(rows, trigger):
+    """
+    Converts fetched message_entry rows to message dictionaries
+
+    :param rows: Rows of id, message_id, user_id and content
+    :type rows: list
+    :param trigger: trigger string for bot
+    :type trigger: str
+    :return: Messages in id order
+    :rtype: list
+    """
+    messages = []
+    for (entry_id, message_id, user_id, content) in rows:
+        messages.append({
+            'id': entry_id,
+            'message': stripTrigger(content, trigger),
+            'message_id': message_id,
+            'user_id': user_id
+        })
+    return messages
+
+def replyQuery(message_id, bot_id, message):
+    """
+    Builds the statement saving a bot reply to a conversation
+
+    :return: Query string and its parameters
+    :rtype: tuple
+    """
+    query = ("INSERT INTO message_entry(message_id, user_id, content, created_at, created_by, updated_at, updated_by) "
+        "VALUES (%(msg_id)s, %(bot_id)s, %(message)s, NOW(), %(bot_id)s, NOW(), %(bot_id)s)")
+    data = {
+      'msg_id': message_id,
+      'bot_id': bot_id,
+      'message': message,
     }
-    return messagedata
+    return query, data
+
+def stripTrigger(content, trigger):
+    """
+    Removes the trigger string in front of a message
+
+    :param content: Message content as stored in Humhub
+    :type content: str
+    :param trigger: trigger string for bot
+    :type trigger: str
+    :return: Message without trigger and surrounding whitespace
+    :rtype: str
+    """
+    if content[:len(trigger)] == trigger:
+        content = content[len(trigger):]
+    return content.strip()
 
 def create_new_conversation(cursor, title, message, user_id, bot_id):
     """
@@ -203,12 +1019,11 @@ def getUsersInConversation(cursor, sender_id, bot_id):
     :return: List of users in conversation
     :rtype: list
     """
-    query = ("""SELECT user_id FROM user_message WHERE message_id = {}
-            """).format(sender_id)
-    cursor.execute(query)
+    query = "SELECT user_id FROM user_message WHERE message_id = %s"
+    cursor.execute(query, (sender_id,))
     users = []
     for user_id in cursor:
-        if user_id != bot_id:
+        if user_id[0] != bot_id:
             users.append(user_id[0])
     return users
 
@@ -226,172 +1041,383 @@ def getCalendar(user_id, date, cursor):
     :return: Calendar pattern with set busy dates of user_id
     :rtype: dict
     """
-    # create calendar pattern
-    calendarPattern = createCalendarPattern()
-
-    # get busy appointments
-    startdate = date.strftime("%Y-%m-%d 00:00:00")
-    enddate = date.strftime("%Y-%m-%d 23:59:59")
-    startdate = "'" + startdate + "'"
-    enddate = "'" + enddate + "'"
-
-    #query = ("""SELECT start_datetime, end_datetime FROM calendar_entry
-    #            INNER JOIN calendar_entry_participant ON
-    #            calendar_entry.id =
-    #            calendar_entry_participant.calendar_entry_id
-    #            WHERE calendar_entry_participant.user_id = {} AND
-    #            calendar_entry_participant.participation_state = 3 AND
-    #            calendar_entry.start_datetime BETWEEN {} AND {}
-    #        """).format(user_id, startdate, enddate)
-    #cursor.execute(query)
-    try:
-        dates = get_google_calendar_items(user_id)
-    except:
-        # not authenticated
-        bot_id = getBotID(cursor)
-        send_auth_link(cursor, user_id, bot_id)
-        raise NotAuthenticatedError
-    #for (start_datetime, end_datetime) in cursor:
-    #    busydates.append([start_datetime, end_datetime])
-    #cnx.close()
-
-    return setBusyDates(calendarPattern, dates)
+    return maskToPattern(getCalendarMask(user_id, date, cursor))
 
 
-def setBusyDates(calendarPattern, dates):
+def getCalendarMask(user_id, date, cursor):
     """
-    Sets busy dates in a given calendar pattern using calendar information
+    Gets the busy slots of a given Humhub User ID as bitmask
 
-    :param calendarPattern: Blank calendar pattern
-    :type calendarPattern: array
-    :param cursor: Array containing start and end datetimes of busy dates
-    :type cursor: array
-    :return: Calendarpattern with set busy dates
-    :rtype: dict
+    :param user_id: Humhub user ID to get the calendar information from
+    :type user_id: int
+    :param date: Specific date to get the calendar information
+    :type date: datetime
+    :param cursor: Mysql Cursor
+    :type cusor: mysql.connector.cursor.MySQLCursor
+    :return: Bitmask with busy slots of user_id set
+    :rtype: int
     """
-    # Google Edition
-    for appointment in dates:
-        start = dates[appointment]['start'] # format: 2018-05-24T17:00:00
-        end = dates[appointment]['end']
-        start_datetime = strptime(start, "%Y-%m-%dT%H:%M:%S")
-        end_datetime = strptime(end, "%Y-%m-%dT%H:%M:%S")
-        # convert minute to array index, round down as its starting time
-        startIndex = int(float(start_datetime.minute) / 15.)
-        # end minute index is round up
-        endIndex = int(math.ceil(float(end_datetime.minute) / 15.))
-        endAtZero = False
-        if endIndex == 0:
-            endAtZero = True
-        else:
-            endIndex -= 1  # correct index for all cases except 0
-        # set all patterns to 0 between start and end indezes
-        for i in range(start_datetime.hour, end_datetime.hour + 1):
-            if start_datetime.hour == end_datetime.hour:
-                for j in range(startIndex, endIndex + 1):
-                    calendarPattern[i][j] = 1
-                break
-            # three cases: i = start.hour, i = end.hour or between
-            if i == start_datetime.hour:
-                # only set to 0 beginning from startIndex to 3
-                for j in range(startIndex, 4):
-                    calendarPattern[i][j] = 1
-            elif i == end_datetime.hour:
-                if endAtZero:
-                    break
-                # only set to 0 beginning from 0 to endIndex
-                for j in range(endIndex + 1):
-                    calendarPattern[i][j] = 1
-            else:
-                # set all to 0
-                for j in range(0, 4):
-                    calendarPattern[i][j] = 1
-
-    # Humhub Edition
-    #for (start_datetime, end_datetime) in cursor:
-    #    # convert minute to array index, round down as its starting time
-    #    startIndex = int(float(start_datetime.minute) / 15.)
-    #    # end minute index is round up
-    #    endIndex = int(math.ceil(float(end_datetime.minute) / 15.))
-    #    endAtZero = False
-    #    if endIndex == 0:
-    #        endAtZero = True
-    #    else:
-    #        endIndex -= 1  # correct index for all cases except 0
-    #    # set all patterns to 0 between start and end indezes
-    #    for i in range(start_datetime.hour, end_datetime.hour + 1):
-    #        if start_datetime.hour == end_datetime.hour:
-    #            for j in range(startIndex, endIndex + 1):
-    #                calendarPattern[i][j] = 1
-    #            break
-    #        # three cases: i = start.hour, i = end.hour or between
-    #        if i == start_datetime.hour:
-    #            # only set to 0 beginning from startIndex to 3
-    #            for j in range(startIndex, 4):
-    #                calendarPattern[i][j] = 1
-    #        elif i == end_datetime.hour:
-    #            if endAtZero:
-    #                break
-    #            # only set to 0 beginning from 0 to endIndex
-    #            for j in range(endIndex + 1):
-    #                calendarPattern[i][j] = 1
-    #        else:
-    #            # set all to 0
-    #            for j in range(0, 4):
-    #                calendarPattern[i][j] = 1
-    return calendarPattern
-
+    return getCalendarRange(user_id, date, date, cursor)[date.date()]
 
 
-def createCalendarPattern(datefrom=None, dateto=None):
+def getCalendarRange(user_id, datefrom, dateto, cursor):
     """
-    Creates blank calendar pattern for one day or for timeframe between
-    datefrom and dateto
+    Gets the busy slots of a given Humhub User ID for every day between
+    datefrom and dateto with a single calendar fetch. Kept for the 15 minute
+    bitmask search, the connector searches with suggestSlots.
 
-    :param datefrom: Start datetime for free timeframe
+    :param user_id: Humhub user ID to get the calendar information from
+    :type user_id: int
+    :param datefrom: First day to get the calendar information for
     :type datefrom: datetime
-    :param dateto: End datetime for free timeframe
+    :param dateto: Last day to get the calendar information for
     :type dateto: datetime
-    :return: Blank calendarpattern
+    :param cursor: Mysql Cursor
+    :type cusor: mysql.connector.cursor.MySQLCursor
+    :return: Bitmasks with busy slots of user_id set by day
+    :rtype: dict
+    """
+    days = getCalendarDays(user_id, datefrom, dateto, cursor)
+    return dict((day, intervalsMask(days[day])) for day in days)
+
+
+def getCalendarDays(user_id, datefrom, dateto, cursor):
+    """
+    Gets the busy appointments of a given Humhub User ID for every day
+    between datefrom and dateto, using the calendar cache
+
+    :return: Appointments clipped to their day by day
+    :rtype: dict
+    """
+    days = getCachedRange(user_id, datefrom.date(), dateto.date())
+    if days is None:
+        days = bucketIntervals(getCalendarItems(user_id, cursor),
+                               datefrom.date(), dateto.date())
+        cacheRange(user_id, days)
+    return days
+
+
+def getCachedRange(user_id, firstDay, lastDay):
+    """
+    Gets the cached appointments of a user for every day between firstDay and
+    lastDay
+
+    :return: Appointments by day or None if a day is not cached
+    :rtype: dict
+    """
+    days = {}
+    day = firstDay
+    while day <= lastDay:
+        days[day] = calendarCache.get(user_id, day)
+        if days[day] is None:
+            return None
+        day += timedelta(days=1)
+    return days
+
+
+def cacheRange(user_id, days):
+    """
+    Caches the appointments by day of a user
+    """
+    for day in days:
+        calendarCache.put(user_id, day, days[day])
+
+
+def getCalendarItems(user_id, cursor):
+    """
+    Gets all busy appointments of a given Humhub User ID, sends an auth link
+    to users not authenticated yet
+
+    :param user_id: Humhub user ID to get the calendar information from
+    :type user_id: int
+    :param cursor: Mysql Cursor
+    :type cusor: mysql.connector.cursor.MySQLCursor
+    :return: Start and end datetime of each appointment
+    :rtype: list
+    """
+    try:
+        return fetchCalendarItems(user_id)
+    except NotAuthenticatedError:
+        bot_id = getBotID(cursor)
+        send_auth_link(cursor, user_id, bot_id)
+        raise
+
+
+def fetchCalendarItems(user_id):
+    """
+    Fetches all busy appointments of a given Humhub User ID from the external
+    calendar, does not use the database so it can run on any thread
+
+    :param user_id: Humhub user ID to get the calendar information from
+    :type user_id: int
+    :return: Start and end datetime of each appointment
+    :rtype: list
+    """
+    try:
+        dates = get_google_calendar_items(user_id)
+    except:
+        # not authenticated
+        raise NotAuthenticatedError([user_id])
+    return calendarIntervals(dates)
+
+
+def calendarIntervals(dates):
+    """
+    Parses calendar items to start and end datetimes
+
+    :param dates: Calendar items containing start and end datetimes as strings
+    :type dates: dict
+    :return: Start and end datetime of each appointment
+    :rtype: list
+    """
+    intervals = []
+    for appointment in dates:
+        start = dates[appointment]['start'] # format: 2018-05-24T17:00:00
+        end = dates[appointment]['end']
+        intervals.append((datetime.strptime(start, "%Y-%m-%dT%H:%M:%S"),
+                          datetime.strptime(end, "%Y-%m-%dT%H:%M:%S")))
+    return intervals
+
+
+def bucketIntervals(intervals, firstDay, lastDay):
+    """
+    Sorts appointments by day, appointments spanning midnight are split
+    between the days
+
+    :param intervals: Start and end datetime of each appointment
+    :type intervals: list
+    :param firstDay: First day to sort appointments into
+    :type firstDay: date
+    :param lastDay: Last day to sort appointments into
+    :type lastDay: date
+    :return: Appointments clipped to their day by day
+    :rtype: dict
+    """
+    days = {}
+    day = firstDay
+    while day <= lastDay:
+        days[day] = []
+        day += timedelta(days=1)
+    for (start, end) in intervals:
+        day = max(start.date(), firstDay)
+        while day <= min(end.date(), lastDay):
+            midnight = datetime.combine(day, datetime.min.time())
+            dayStart = max(start, midnight)
+            dayEnd = min(end, midnight + timedelta(days=1))
+            if dayStart < dayEnd:
+                days[day].append((dayStart, dayEnd))
+            day += timedelta(days=1)
+    for day in days:
+        days[day] = tuple(days[day])
+    return days
+
+
+def intervalsMask(intervals):
+    """
+    Converts appointments of a single day to a bitmask of busy slots.
+    Starting times are rounded down, ending times rounded up to the slot grid.
+
+    :param intervals: Start and end datetime of each appointment
+    :type intervals: list
+    :return: Bitmask with busy slots set
+    :rtype: int
+    """
+    mask = 0
+    for (start, end) in intervals:
+        startSlot = (start.hour * SLOTS_PER_HOUR +
+                     int(float(start.minute) / 15.))
+        if end.date() > start.date():
+            endSlot = SLOTS_PER_DAY
+        else:
+            endSlot = (end.hour * SLOTS_PER_HOUR +
+                       int(math.ceil(float(end.minute) / 15.)))
+        mask |= slotRangeMask(startSlot, endSlot)
+    return mask
+
+
+def bucketBusyMasks(intervals, firstDay, lastDay):
+    """
+    Sorts appointments into one busy slot bitmask per day, appointments
+    spanning midnight are split between the days
+
+    :param intervals: Start and end datetime of each appointment
+    :type intervals: list
+    :param firstDay: First day to create a bitmask for
+    :type firstDay: date
+    :param lastDay: Last day to create a bitmask for
+    :type lastDay: date
+    :return: Bitmasks with busy slots set by day
+    :rtype: dict
+    """
+    days = bucketIntervals(intervals, firstDay, lastDay)
+    return dict((day, intervalsMask(days[day])) for day in days)
+
+
+def slotRangeMask(startSlot, endSlot):
+    """
+    Creates a bitmask with the slots from startSlot up to endSlot set
+
+    :param startSlot: First slot index
+    :type startSlot: int
+    :param endSlot: Slot index after the last slot
+    :type endSlot: int
+    :return: Bitmask
+    :rtype: int
+    """
+    startSlot = min(max(startSlot, 0), SLOTS_PER_DAY)
+    endSlot = min(max(endSlot, 0), SLOTS_PER_DAY)
+    if endSlot <= startSlot:
+        return 0
+    return ((1 << endSlot) - 1) ^ ((1 << startSlot) - 1)
+
+
+def busyMask(dates):
+    """
+    Converts calendar items to a bitmask of busy slots. Starting times are
+    rounded down, ending times rounded up to the slot grid.
+
+    :param dates: Calendar items containing start and end datetimes as strings
+    :type dates: dict
+    :return: Bitmask with busy slots set
+    :rtype: int
+    """
+    mask = 0
+    # Google Edition
+    for appointment in dates:
+        start = dates[appointment]['start'] # format: 2018-05-24T17:00:00
+        end = dates[appointment]['end']
+        start_datetime = datetime.strptime(start, "%Y-%m-%dT%H:%M:%S")
+        end_datetime = datetime.strptime(end, "%Y-%m-%dT%H:%M:%S")
+        mask |= slotRangeMask(
+            start_datetime.hour * SLOTS_PER_HOUR +
+            int(float(start_datetime.minute) / 15.),
+            end_datetime.hour * SLOTS_PER_HOUR +
+            int(math.ceil(float(end_datetime.minute) / 15.)))
+    return mask
+
+
+def patternToMask(calendarPattern):
+    """
+    Converts a calendar pattern to a bitmask, slot hour * 4 + quarter is set
+    if the pattern is busy at that time
+
+    :param calendarPattern: Calendar pattern
+    :type calendarPattern: array
+    :return: Bitmask with busy slots set
+    :rtype: int
+    """
+    mask = 0
+    for i in range(24):
+        for j in range(SLOTS_PER_HOUR):
+            if calendarPattern[i][j] == 1:
+                mask |= 1 << (i * SLOTS_PER_HOUR + j)
+    return mask
+
+
+def maskToPattern(mask):
+    """
+    Converts a bitmask to a calendar pattern
+
+    :param mask: Bitmask with busy slots set
+    :type mask: int
+    :return: Calendar pattern
+    :rtype: array
+    """
+    return [[(mask >> (i * SLOTS_PER_HOUR + j)) & 1
+             for j in range(SLOTS_PER_HOUR)]
+            for i in range(24)]
+
+
+def freeRunMask(mask, slots):
+    """
+    Gets all slots starting a run of at least slots free slots
+
+    :param mask: Bitmask with busy slots set
+    :type mask: int
+    :param slots: Number of consecutive free slots needed
+    :type slots: int
+    :return: Bitmask with run starting slots set
+    :rtype: int
+    """
+    free = ~mask & FULL_DAY
+    runs = free
+    for k in range(1, slots):
+        runs &= free >> k
+    return runs
+
+
+def getFreeSlot(mask, slots, timesSearched, startSlot, endSlot):
+    """
+    Gets the first free run of slots starting between startSlot and endSlot,
+    skipping timesSearched runs that do not overlap each other
+
+    :return: Starting slot of the run or None and the number of runs still
+             to be skipped
+    :rtype: tuple
+    """
+    starts = freeRunMask(mask, slots) & slotRangeMask(startSlot, endSlot)
+    while starts:
+        slot = (starts & -starts).bit_length() - 1
+        if timesSearched == 0:
+            return slot, 0
+        timesSearched -= 1
+        # next suggestion must not overlap the skipped one
+        starts &= ~((1 << (slot + slots)) - 1)
+    return None, timesSearched
+
+
+def createCalendarPattern(datefrom=None, dateto=None):
+    """
+    Creates blank calendar pattern for one day or for timeframe between
+    datefrom and dateto
+
+    :param datefrom: Start datetime for free timeframe
+    :type datefrom: datetime
+    :param dateto: End datetime for free timeframe
+    :type dateto: datetime
+    :return: Blank calendarpattern
     :rtype: dict
     """
-    # matching against standardized calendar
-    calendarPattern = []
-    if datefrom and dateto:
-        # set to busy = 1 except given range
-        for i in range(24):
-            calendarPattern.append(i)
-            calendarPattern[i] = []
-            for j in range(4):
-                calendarPattern[i].append(j)
-                calendarPattern[i][j] = 1
-        # get time
-        timefrom = datetime.strptime(datefrom, '%Y-%m-%dT%H:%M:%S.000Z')
-        timeto = datetime.strptime(dateto, '%Y-%m-%dT%H:%M:%S.000Z')
-        # round minute to next or before quarter
-        startIndex = int(math.ceil(float(timefrom.minute) / 15.))
-        endIndex = int(float(timeto.minute) / 15.) - 1
-        # set timeframe to 0 = free
-        for i in range(timefrom.hour, timeto.hour + 1):
-            if i == timefrom.hour:
-                for j in range(startIndex, 4):
-                    calendarPattern[i][j] = 0
-            elif i == timeto.hour:
-                for j in range(endIndex + 1):
-                    calendarPattern[i][j] = 0
-            else:
-                for j in range(0, 4):
-                    calendarPattern[i][j] = 0
-    else:
-        # set to free = 0 for hole day
-        for i in range(24):
-            calendarPattern.append(i)
-            calendarPattern[i] = []
-            for j in range(4):
-                calendarPattern[i].append(j)
-                calendarPattern[i][j] = 0
     # pattern: [5][0] for 05:00, [5][1] for 05:15, [5][2] for 05:30,
     # [5][3] for 05:45, [6][0] for 06:00 and so on
-    return calendarPattern
+    return maskToPattern(createCalendarMask(datefrom, dateto))
+
+
+def createCalendarMask(datefrom=None, dateto=None):
+    """
+    Creates blank calendar bitmask for one day or with everything except the
+    timeframe between datefrom and dateto set busy
+
+    :param datefrom: Start datetime for free timeframe
+    :type datefrom: str
+    :param dateto: End datetime for free timeframe
+    :type dateto: str
+    :return: Bitmask with busy slots set
+    :rtype: int
+    """
+    if datefrom and dateto:
+        timefrom = datetime.strptime(datefrom, '%Y-%m-%dT%H:%M:%S.000Z')
+        timeto = datetime.strptime(dateto, '%Y-%m-%dT%H:%M:%S.000Z')
+        # round minute to next or before quarter
+        return FULL_DAY & ~slotRangeMask(
+            timefrom.hour * SLOTS_PER_HOUR +
+            int(math.ceil(float(timefrom.minute) / 15.)),
+            timeto.hour * SLOTS_PER_HOUR + int(float(timeto.minute) / 15.))
+    return 0
+
+
+def setBusyDates(calendarPattern, dates):
+    """
+    Sets busy dates in a given calendar pattern using calendar information
+
+    :param calendarPattern: Blank calendar pattern
+    :type calendarPattern: array
+    :param cursor: Array containing start and end datetimes of busy dates
+    :type cursor: array
+    :return: Calendarpattern with set busy dates
+    :rtype: dict
+    """
+    return maskToPattern(patternToMask(calendarPattern) | busyMask(dates))
 
 
 def matchCalendars(calendars):
@@ -403,21 +1429,12 @@ def matchCalendars(calendars):
     :return: Matched calendarpattern
     :rtype: dict
     """
-    calendarPattern = []
-    for i in range(24):
-        calendarPattern.append(i)
-        calendarPattern[i] = []
-        for j in range(4):
-            calendarPattern[i].append(j)
-            calendarPattern[i][j] = 0
+    mask = 0
     for calendar in calendars:
         if calendar is not None:
-            for i in range(24):
-                for j in range(4):
-                    if calendar[i][j] == 1:
-                        calendarPattern[i][j] = 1
-    # available dates have value 1, busy dates 0
-    return calendarPattern
+            mask |= patternToMask(calendar)
+    # busy dates have value 1, available dates 0
+    return maskToPattern(mask)
 
 
 def getDateSuggestion(calendar,
@@ -450,43 +1467,28 @@ def getDateSuggestion(calendar,
     :return: Hour and Minute of free appointment
     :rtype: list
     """
+    slot, timesSearched = getFreeSlot(
+        patternToMask(calendar),
+        durationSlots(duration),
+        timesSearched or 0,
+        beginHour * SLOTS_PER_HOUR + beginMinuteIndex,
+        endHour * SLOTS_PER_HOUR)
+    if slot is None:
+        return [timesSearched]
+    return [int(slot / SLOTS_PER_HOUR), (slot % SLOTS_PER_HOUR) * 15]
+
+
+def durationSlots(duration):
+    """
+    Converts a duration in minutes to a number of slots, rounded up
+
+    :param duration: Duration in minutes, defaults to one slot
+    :type duration: int
+    :rtype: int
+    """
     if duration == 0 or duration is None:
         duration = 15
-    # transfer duration to minute indezes
-    durationindezes = int(math.ceil(float(duration) / 15.))
-    if timesSearched is None:
-        timesSearched = 0
-    # take next date where all required (duration) indezes are 1
-    for i in range(beginHour, endHour):
-        if beginHour == i:
-            rangej = beginMinuteIndex
-        else:
-            rangej = 0
-        for j in range(rangej, 4):
-            if calendar[i][j] == 0:
-                founddate = True
-                # look for j + durationindezes values
-                for d in range(1, durationindezes):
-                    n = j + d
-                    if calendar[i + int(n / 4)][n % 4] == 1:
-                        founddate = False
-                        # set i and j to new values
-                        # to skip already checked dates
-                        i = i + int(n / 4)
-                        j = n % 4
-                        break
-                    else:
-                        continue
-                # hour = i, minute = j
-                if founddate:
-                    if timesSearched == 0:
-                        return [i, j * 15]
-                    else:
-                        # skip
-                        i = i + int((durationindezes + j) / 4)
-                        j = (durationindezes + j) % 4
-                        timesSearched -= 1
-    return [timesSearched]
+    return int(math.ceil(float(duration) / 15.))
 
 
 def suggestDate(
@@ -502,8 +1504,9 @@ def suggestDate(
     cnx
 ):
     """
-    Gets calendars of users and calls the free date searching method
-    getDateSuggestion
+    Gets calendars of users and searches the first free 15 minute slot on
+    bitmasks. Kept for compatibility, the connector searches appointments
+    with suggestSlots.
 
     :param datefrom: Starting datetime to be searched
     :type datefrom: datetime
@@ -526,46 +1529,530 @@ def suggestDate(
     :type begiendHournHour: int
     :param endMinuteIndex: Index of ending quarter to be searched (x times 15)
     :type endMinuteIndex: int
+    :return: Hour, minute and day of the free date or empty list
+    :rtype: list
     """
-    calendarPattern = []
+    if numpy is not None:
+        return suggestDateMatrix(datefrom, dateto, duration, users,
+                                 timesSearched, beginHour, beginMinuteIndex,
+                                 endHour, endHourIndex, cnx)
     dtfrom = datetime.strptime(datefrom, '%Y-%m-%dT%H:%M:%S.000Z')
     dtto = datetime.strptime(dateto, '%Y-%m-%dT%H:%M:%S.000Z')
+    slots = durationSlots(duration)
+    timesSearched = timesSearched or 0
+    calendars = getCalendars(users, dtfrom, dtto, cnx)
     while dtfrom < dtto:
-        calendarPattern = createCalendarPattern()
-        # get users calendars
-        calendars = []
-        auth = True
+        # merge users calendars
+        mask = 0
         for user in users:
-            try:
-                calendar = getCalendar(user, dtfrom, cnx)
-                calendars.append(calendar)
-            except:
-                auth = False
-        if auth == False:
-            raise NotAuthenticatedError
+            mask |= calendars[user][dtfrom.date()]
         # get free date
-        calendars.append(calendarPattern)
-        datesuggest = None
-        datesuggest = matchCalendars(calendars)
-
-        # gets hour and minute, needs to be combined with extracted date
-        suggestion = getDateSuggestion(
-            datesuggest,
-            duration,
+        slot, timesSearched = getFreeSlot(
+            mask,
+            slots,
             timesSearched,
-            beginHour,
-            beginMinuteIndex,
-            endHour,
-            endHourIndex
-        )
-        if len(suggestion) == 1:
-            timesSearched = suggestion[0]
-            dtfrom = dtfrom + timedelta(days=1)
-        if len(suggestion) == 2:
-            return suggestion
+            beginHour * SLOTS_PER_HOUR + beginMinuteIndex,
+            endHour * SLOTS_PER_HOUR)
+        if slot is not None:
+            return [int(slot / SLOTS_PER_HOUR),
+                    (slot % SLOTS_PER_HOUR) * 15,
+                    dtfrom]
+        dtfrom = dtfrom + timedelta(days=1)
     return []
 
 
+def getCalendars(users, datefrom, dateto, cnx):
+    """
+    Gets the busy slot bitmasks of all users for every day of the search
+    window, each users calendar is fetched once
+
+    :param users: List of Humhub User IDs to get calendars from
+    :type users: list
+    :param datefrom: Start of the search window
+    :type datefrom: datetime
+    :param dateto: End of the search window
+    :type dateto: datetime
+    :return: Bitmasks by day for each user
+    :rtype: dict
+    """
+    calendars = getCalendarIntervals(users, datefrom, dateto, cnx)
+    for user in calendars:
+        calendars[user] = dict((day, intervalsMask(calendars[user][day]))
+                               for day in calendars[user])
+    return calendars
+
+
+def getCalendarIntervals(users, datefrom, dateto, cnx):
+    """
+    Gets the busy appointments of all users by day for the search window.
+    Calendars not cached are fetched concurrently, once per user, all fetches
+    share a single timeout.
+
+    :param users: List of Humhub User IDs to get calendars from
+    :type users: list
+    :param datefrom: Start of the search window
+    :type datefrom: datetime
+    :param dateto: End of the search window
+    :type dateto: datetime
+    :return: Appointments by day for each user
+    :rtype: dict
+    """
+    calendars = {}
+    pending = {}
+    for user in users:
+        calendars[user] = getCachedRange(user, datefrom.date(), dateto.date())
+        if calendars[user] is None and user not in pending:
+            pending[user] = fetchCalendarAsync(user)
+    unauthenticated = []
+    timedout = []
+    deadline = time() + calendarTimeout
+    for user in pending:
+        try:
+            items = pending[user].get(max(deadline - time(), 0))
+        except NotAuthenticatedError:
+            unauthenticated.append(user)
+        except multiprocessing.TimeoutError:
+            timedout.append(user)
+        else:
+            calendars[user] = bucketIntervals(items, datefrom.date(),
+                                              dateto.date())
+            cacheRange(user, calendars[user])
+    if len(unauthenticated) > 0:
+        bot_id = getBotID(cnx)
+        for user in unauthenticated:
+            send_auth_link(cnx, user, bot_id)
+        raise NotAuthenticatedError(unauthenticated)
+    if len(timedout) > 0:
+        retireCalendarWorkers()
+        raise CalendarTimeoutError(timedout)
+    return calendars
+
+
+def fetchCalendarAsync(user_id):
+    """
+    Starts fetching the calendar of a user on the calendar workers. A fetch
+    still running from an earlier search is reused instead of occupying
+    another worker.
+
+    :param user_id: Humhub user ID to get the calendar information from
+    :type user_id: int
+    :rtype: multiprocessing.pool.AsyncResult
+    """
+    with calendarWorkersLock:
+        result = calendarFetches.get(user_id)
+    if result is None or result.ready():
+        result = getCalendarWorkers().apply_async(fetchCalendarItems,
+                                                  (user_id,))
+        with calendarWorkersLock:
+            calendarFetches[user_id] = result
+    return result
+
+
+def retireCalendarWorkers():
+    """
+    Replaces the calendar workers after fetches timed out, so hung fetches
+    do not block the following searches. The old workers finish their
+    fetches and exit.
+    """
+    global calendarWorkers
+    with calendarWorkersLock:
+        if calendarWorkers is not None:
+            calendarWorkers.close()
+            calendarWorkers = None
+
+
+def getCalendarWorkers():
+    """
+    Gets the thread pool fetching calendars, created on first use
+
+    :rtype: multiprocessing.pool.ThreadPool
+    """
+    global calendarWorkers
+    with calendarWorkersLock:
+        if calendarWorkers is None:
+            calendarWorkers = ThreadPool(calendarWorkerCount)
+    return calendarWorkers
+
+
+def configureCalendarWorkers(workers, timeout):
+    """
+    Sets number of concurrent calendar fetches and the timeout of a search
+
+    :param workers: Maximum number of calendars fetched concurrently
+    :type workers: int
+    :param timeout: Seconds to wait for all calendar fetches of a search
+    :type timeout: float
+    """
+    global calendarWorkerCount, calendarTimeout
+    calendarWorkerCount = max(int(workers), 1)
+    calendarTimeout = timeout
+
+
+def maskToArray(mask):
+    """
+    Converts a day bitmask to a boolean NumPy array with one entry per slot
+
+    :param mask: Bitmask with busy slots set
+    :type mask: int
+    :rtype: numpy.ndarray
+    """
+    half = SLOTS_PER_DAY // 2
+    words = numpy.array([mask & ((1 << half) - 1), mask >> half],
+                        dtype=numpy.int64)
+    bits = (words[:, None] >> numpy.arange(half, dtype=numpy.int64)) & 1
+    return bits.reshape(SLOTS_PER_DAY).astype(bool)
+
+
+def getFreeSlotMatrix(busy, slots, timesSearched, startSlot, endSlot):
+    """
+    Gets the n-th free run of slots in a users x days x slots matrix of busy
+    slots. Runs are found for all days at once with a sliding window sum
+    along the slot axis.
+
+    :param busy: Busy slots of all users on all days
+    :type busy: numpy.ndarray
+    :param slots: Number of consecutive free slots needed
+    :type slots: int
+    :param timesSearched: Number of non-overlapping runs to skip
+    :type timesSearched: int
+    :param startSlot: First slot a run may start at
+    :type startSlot: int
+    :param endSlot: Slot index after the last slot a run may start at
+    :type endSlot: int
+    :return: Day index and starting slot or None if there is no such run
+    :rtype: tuple
+    """
+    anybusy = busy.any(axis=0).astype(numpy.int32)
+    days = anybusy.shape[0]
+    if slots > SLOTS_PER_DAY or days == 0:
+        return None
+    window = numpy.zeros((days, SLOTS_PER_DAY + 1), dtype=numpy.int32)
+    numpy.cumsum(anybusy, axis=1, out=window[:, 1:])
+    # busy slots in every window of the needed length
+    counts = window[:, slots:] - window[:, :-slots]
+    starts = counts == 0
+    starts[:, :max(startSlot, 0)] = False
+    starts[:, max(endSlot, 0):] = False
+    lastDay = -1
+    lastEnd = 0
+    for day, slot in numpy.argwhere(starts):
+        if day == lastDay and slot < lastEnd:
+            continue # overlaps the skipped suggestion
+        if timesSearched == 0:
+            return int(day), int(slot)
+        timesSearched -= 1
+        lastDay = day
+        lastEnd = slot + slots
+    return None
+
+
+def suggestDateMatrix(
+    datefrom,
+    dateto,
+    duration,
+    users,
+    timesSearched,
+    beginHour,
+    beginMinuteIndex,
+    endHour,
+    endHourIndex,
+    cnx
+):
+    """
+    Same as suggestDate, but builds one users x days x slots matrix for the
+    whole timeframe and searches all days in one vectorized pass. Needs
+    NumPy.
+
+    :return: Hour, minute and day of the free date or empty list
+    :rtype: list
+    """
+    dtfrom = datetime.strptime(datefrom, '%Y-%m-%dT%H:%M:%S.000Z')
+    dtto = datetime.strptime(dateto, '%Y-%m-%dT%H:%M:%S.000Z')
+    days = []
+    day = dtfrom
+    while day < dtto:
+        days.append(day)
+        day = day + timedelta(days=1)
+    calendars = getCalendars(users, dtfrom, dtto, cnx)
+    busy = numpy.zeros((len(users), len(days), SLOTS_PER_DAY), dtype=bool)
+    for u, user in enumerate(users):
+        for d, day in enumerate(days):
+            busy[u, d] = maskToArray(calendars[user][day.date()])
+    if len(users) == 0:
+        busy = numpy.zeros((1, len(days), SLOTS_PER_DAY), dtype=bool)
+    found = getFreeSlotMatrix(
+        busy,
+        durationSlots(duration),
+        timesSearched or 0,
+        beginHour * SLOTS_PER_HOUR + beginMinuteIndex,
+        endHour * SLOTS_PER_HOUR)
+    if found is None:
+        return []
+    day, slot = found
+    return [int(slot / SLOTS_PER_HOUR),
+            (slot % SLOTS_PER_HOUR) * 15,
+            days[day]]
+
+
+class CalendarBackend(object):
+    """
+    Source of the busy appointments used by the appointment search
+    """
+    def getBusyIntervals(self, users, datefrom, dateto, cursor):
+        """
+        Gets the busy appointments of all users between datefrom and dateto
+
+        :param users: List of Humhub User IDs to get calendars from
+        :type users: list
+        :param datefrom: Start of the search window
+        :type datefrom: datetime
+        :param dateto: End of the search window
+        :type dateto: datetime
+        :param cursor: Mysql Cursor
+        :type cusor: mysql.connector.cursor.MySQLCursor
+        :return: Appointments by day for each user
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+
+class GoogleCalendarBackend(CalendarBackend):
+    """
+    Reads the users Google calendars, concurrently and through the calendar
+    cache
+    """
+    def getBusyIntervals(self, users, datefrom, dateto, cursor):
+        return getCalendarIntervals(users, datefrom, dateto, cursor)
+
+
+class HumhubCalendarBackend(CalendarBackend):
+    """
+    Reads the accepted entries of the Humhub calendar module, all users and
+    the whole search window with one query
+    """
+    def getBusyIntervals(self, users, datefrom, dateto, cursor):
+        calendars = {}
+        items = {}
+        for user in users:
+            items[user] = []
+        if len(users) > 0:
+            placeholders = ', '.join('%s' for unused in users)
+            query = ("""SELECT calendar_entry_participant.user_id,
+                     calendar_entry.start_datetime, calendar_entry.end_datetime
+                     FROM calendar_entry INNER JOIN calendar_entry_participant
+                     ON calendar_entry.id =
+                     calendar_entry_participant.calendar_entry_id
+                     WHERE calendar_entry_participant.user_id IN ({}) AND
+                     calendar_entry_participant.participation_state = 3 AND
+                     calendar_entry.start_datetime < %s AND
+                     calendar_entry.end_datetime > %s
+                     """).format(placeholders)
+            cursor.execute(query, tuple(users) + (
+                datetime.combine(dateto.date() + timedelta(days=1),
+                                 datetime.min.time()),
+                datetime.combine(datefrom.date(), datetime.min.time())))
+            for (user_id, start_datetime, end_datetime) in cursor.fetchall():
+                items[user_id].append((start_datetime, end_datetime))
+        for user in items:
+            calendars[user] = bucketIntervals(items[user], datefrom.date(),
+                                              dateto.date())
+        return calendars
+
+
+calendarBackends = {
+    'google': GoogleCalendarBackend,
+    'humhub': HumhubCalendarBackend,
+}
+
+
+def getCalendarBackend(name):
+    """
+    Creates the calendar backend configured by name
+
+    :param name: Name of the backend, 'google' or 'humhub'
+    :type name: str
+    :rtype: CalendarBackend
+    """
+    if name not in calendarBackends:
+        raise ValueError("Unknown calendar backend: {}".format(name))
+    return calendarBackends[name]()
+
+
+def mergeIntervals(intervals):
+    """
+    Merges overlapping and adjacent busy intervals with a sorted sweep
+
+    :param intervals: Start and end datetime of each appointment
+    :type intervals: list
+    :return: Sorted, disjoint busy intervals
+    :rtype: list
+    """
+    merged = []
+    for (start, end) in sorted(intervals):
+        if end <= start:
+            continue
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def workingWindows(datefrom, dateto, dayStart, dayEnd):
+    """
+    Creates the working hour windows of every day between datefrom and dateto.
+    If dayEnd is not after dayStart the window ends on the next day, windows
+    touching each other are joined.
+
+    :param datefrom: Start of the search window
+    :type datefrom: datetime
+    :param dateto: End of the search window
+    :type dateto: datetime
+    :param dayStart: Begin of working hours
+    :type dayStart: datetime.time
+    :param dayEnd: End of working hours
+    :type dayEnd: datetime.time
+    :return: Sorted, disjoint windows clipped to datefrom and dateto
+    :rtype: list
+    """
+    windows = []
+    day = datefrom.date() - timedelta(days=1) # window may reach into datefrom
+    while day <= dateto.date():
+        start = datetime.combine(day, dayStart)
+        end = datetime.combine(day, dayEnd)
+        if end <= start:
+            end += timedelta(days=1)
+        start = max(start, datefrom)
+        end = min(end, dateto)
+        if start < end:
+            if windows and start <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(end, windows[-1][1]))
+            else:
+                windows.append((start, end))
+        day += timedelta(days=1)
+    return windows
+
+
+def ceilToGranularity(date, granularity):
+    """
+    Rounds a datetime up to the next multiple of granularity minutes after
+    midnight
+
+    :param date: Datetime to round
+    :type date: datetime
+    :param granularity: Grid in minutes
+    :type granularity: int
+    :rtype: datetime
+    """
+    midnight = datetime.combine(date.date(), datetime.min.time())
+    step = timedelta(minutes=granularity)
+    steps = int(math.ceil((date - midnight).total_seconds() /
+                          step.total_seconds()))
+    return midnight + steps * step
+
+
+def findFreeSlots(busy,
+                  datefrom,
+                  dateto,
+                  duration,
+                  dayStart,
+                  dayEnd,
+                  granularity=15,
+                  count=1,
+                  skip=0):
+    """
+    Finds free dates of at least duration minutes within working hours. Busy
+    intervals of all participants are merged with a sorted sweep and the
+    gaps between them are walked in order, so a search costs O(k log k) for
+    k appointments.
+
+    :param busy: Busy intervals of all participants
+    :type busy: list
+    :param datefrom: Start of the search window
+    :type datefrom: datetime
+    :param dateto: End of the search window
+    :type dateto: datetime
+    :param duration: Needed duration of the free date in minutes
+    :type duration: int
+    :param dayStart: Begin of working hours
+    :type dayStart: datetime.time
+    :param dayEnd: End of working hours
+    :type dayEnd: datetime.time
+    :param granularity: Free dates start at multiples of this many minutes
+    :type granularity: int
+    :param count: Number of free dates to return
+    :type count: int
+    :param skip: Number of free dates to skip
+    :type skip: int
+    :return: Starting datetimes of non-overlapping free dates
+    :rtype: list
+    """
+    length = timedelta(minutes=duration or granularity)
+    merged = mergeIntervals(busy)
+    ends = [end for (start, end) in merged]
+    slots = []
+    for (windowStart, windowEnd) in workingWindows(datefrom, dateto,
+                                                   dayStart, dayEnd):
+        i = bisect.bisect_right(ends, windowStart)
+        free = windowStart
+        while free < windowEnd:
+            if i < len(merged) and merged[i][0] < windowEnd:
+                gapEnd = merged[i][0]
+            else:
+                gapEnd = windowEnd
+            start = ceilToGranularity(free, granularity)
+            while start + length <= gapEnd:
+                if skip > 0:
+                    skip -= 1
+                else:
+                    slots.append(start)
+                    if len(slots) == count:
+                        return slots
+                start = ceilToGranularity(start + length, granularity)
+            if gapEnd == windowEnd:
+                break
+            free = merged[i][1]
+            i += 1
+    return slots
+
+
+def suggestSlots(datefrom,
+                 dateto,
+                 duration,
+                 users,
+                 cnx,
+                 dayStart,
+                 dayEnd,
+                 granularity=15,
+                 count=1,
+                 skip=0,
+                 backend=None):
+    """
+    Gets calendars of users and searches free dates with findFreeSlots
+
+    :param datefrom: Start of the search window
+    :type datefrom: datetime
+    :param dateto: End of the search window
+    :type dateto: datetime
+    :param users: List of Humhub User IDs to get calendars from
+    :type users: list
+    :param backend: Calendar source, defaults to the Google calendars
+    :type backend: CalendarBackend
+    :return: Starting datetimes of non-overlapping free dates
+    :rtype: list
+    """
+    if backend is None:
+        backend = GoogleCalendarBackend()
+    busy = []
+    calendars = backend.getBusyIntervals(users, datefrom, dateto, cnx)
+    for user in calendars:
+        for day in calendars[user]:
+            busy.extend(calendars[user][day])
+    return findFreeSlots(busy, datefrom, dateto, duration, dayStart, dayEnd,
+                         granularity, count, skip)
+
+
 def getEndTime(datetime, duration):
     """
     Gets end time of a free date suggestion using starting datetime and
@@ -597,202 +2084,647 @@ def getUserName(userID):
     :return: Full username
     :rtype: str
     """
-    firstname = ''
-    lastname = ''
     global offlinemode
     if offlinemode:
         return "Christian Schmidt"
-    # search in humhub db
-    cnx = establishDBConnection(dbconfig)
-    cursor = cnx.cursor()
-    query = ("""SELECT firstname, lastname FROM profile WHERE user_id = {}
-            """).format(userID)
-    cursor.execute(query)
-    username = ''
-    for (firstname, lastname) in cursor:
-        username = firstname + " " + lastname
-    cnx.close()
-    return username
+    # search in profile directory, loaded from humhub db
+    with connectionPool.connection() as cnx:
+        return profileDirectory.getName(cnx, userID)
 
 
 def bookdate(cnx, datefrom, duration, users):
     """
-    Books appointment in Humhub database
+    Books appointment in Humhub database. All rows for all participants are
+    built first and written with one multi-row insert per table in a single
+    transaction, which is rolled back on errors.
     """
     # create calendar entry, duration in minutes
-    cursor = cnx.cursor()
-    datetimeNow = "'" + datetime.now().strftime("%Y-%m-%d %H:%M:%S") + "'"
-    if (datefrom.minute + duration) >= 60:
-        dateto = datefrom.replace(
-            hour=datefrom.hour + int((datefrom.minute + duration) / 60),
-            minute=int(datefrom.minute + duration) % 60
-        )
-    else:
-        dateto = datefrom.replace(minute=datefrom.minute + duration)
-
-    # create one calendar entry for each user
+    datetimeNow = datetime.now().replace(microsecond=0)
+    dateto = datefrom + timedelta(minutes=duration)
+    users = list(users)
+    if len(users) == 0:
+        return []
+
+    # get user names for description except own id
+    names = dict((user, getUserName(user)) for user in users)
+    descriptions = []
     for user in users:
-        # get user names for description except own id
-        description = 'Termin mit '
-        for user2 in users:
-            if user is not user2:
-                description += getUserName(user2) + ", "
-        description = description[:-2]
-        # get container id
-        query = ("""SELECT `id` AS `cID` FROM `contentcontainer` WHERE
-            `class` = 'humhub\\\\modules\\\\user\\\\models\\\\User' AND
-            `pk` = %s AND `owner_user_id` = %s""")
-        data = (user, user)
-        cursor.execute(query, data)
-        for cID in cursor:
-            containerID = cID[0]
-        # create entry
-        query = (("""INSERT INTO calendar_entry(title, description,
+        descriptions.append('Termin mit ' + ", ".join(
+            names[user2] for user2 in users if user2 != user))
+    calendarModel = 'humhub\\modules\\calendar\\models\\CalendarEntry'
+    guids = guidAllocator.allocate(cnx, 2 * len(users))
+    contentGUIDs = guids[:len(users)]
+    activityGUIDs = guids[len(users):]
+
+    cursor = cnx.cursor()
+    try:
+        containerIDs = getContainerIDs(cursor, users)
+        cnx.start_transaction()
+        # auto increment IDs of a multi-row insert are this far apart
+        step = getAutoIncrementIncrement(cursor)
+
+        # create one calendar entry for each user
+        entryIDs = insertRows(
+            cursor,
+            """INSERT INTO calendar_entry(title, description,
                 start_datetime, end_datetime, all_day, participation_mode,
                 color, allow_decline, allow_maybe, time_zone,
                 participant_info, closed) VALUES
-                ('Termin', '{}', {}, {}, 0, 2, '#59d6e4', 1, 1,
-                'Europe/Berlin', '', 0);""").format(
-            description,
-            str("'" + datefrom.strftime("%Y-%m-%d %H:%M:%S") + "'"),
-            str("'" + dateto.strftime("%Y-%m-%d %H:%M:%S") + "'")))
-        cursor.execute(query)
-        cnx.commit()
-        # get id of entry created
-        calendarEntryID = cursor.lastrowid
+                ('Termin', %s, %s, %s, 0, 2, '#59d6e4', 1, 1,
+                'Europe/Berlin', '', 0)""",
+            [(description, datefrom, dateto) for description in descriptions],
+            step)
 
         # insert activity
-        query = ("""INSERT INTO `activity`
+        insertRows(
+            cursor,
+            """INSERT INTO `activity`
                 (`class`, `module`, `object_model`, `object_id`)
-                VALUES (%s, 'content', %s, %s);""")
-        data = ('humhub\\modules\\content\\activities\\ContentCreated',
-                'humhub\\modules\\calendar\\models\\CalendarEntry',
-                calendarEntryID)
-        cursor.execute(query, data)
-        cnx.commit()
+                VALUES (%s, 'content', %s, %s)""",
+            [('humhub\\modules\\content\\activities\\ContentCreated',
+              calendarModel,
+              entryID) for entryID in entryIDs])
 
         # insert participation
-        query = (("""INSERT INTO calendar_entry_participant
+        insertRows(
+            cursor,
+            """INSERT INTO calendar_entry_participant
                 (calendar_entry_id, user_id, participation_state)
-                 VALUES ({}, {}, 3);""").format(calendarEntryID, user))
-        cursor.execute(query)
-        cnx.commit()
+                VALUES (%s, %s, 3)""",
+            list(zip(entryIDs, users)))
 
-        query = ("""INSERT INTO `content`
+        insertRows(
+            cursor,
+            """INSERT INTO `content`
             (`guid`, `object_model`, `object_id`, `visibility`, `pinned`,
              `archived`, `created_at`, `created_by`, `updated_at`,
              `updated_by`, `contentcontainer_id`, `stream_sort_date`,
              `stream_channel`) VALUES
-             (%s, %s, %s, 1, 0, '0', %s, 5, %s, 5, %s, %s, 'default');""")
-        data = (buildGUID(cnx),
-                'humhub\\modules\\calendar\\models\\CalendarEntry',
-                calendarEntryID,
-                datetimeNow,
-                datetimeNow,
-                containerID,
-                datetimeNow)
-        cursor.execute(query, data)
-        cnx.commit()
-
-        query = (("""INSERT INTO user_follow
+             (%s, %s, %s, 1, 0, '0', %s, 5, %s, 5, %s, %s, 'default')""",
+            [(contentGUIDs[i],
+              calendarModel,
+              entryIDs[i],
+              datetimeNow,
+              datetimeNow,
+              containerIDs.get(users[i]),
+              datetimeNow) for i in range(len(users))])
+
+        insertRows(
+            cursor,
+            """INSERT INTO user_follow
                 (object_model, object_id, user_id, send_notifications)
-                 VALUES (%s, %s, %s, 1);"""))
-        data = ('humhub\\modules\\calendar\\models\\CalendarEntry',
-                calendarEntryID,
-                user)
-        cursor.execute(query, data)
-        cnx.commit()
+                VALUES (%s, %s, %s, 1)""",
+            [(calendarModel, entryIDs[i], users[i])
+             for i in range(len(users))])
 
-        query = ("""INSERT INTO `activity`
+        activityIDs = insertRows(
+            cursor,
+            """INSERT INTO `activity`
                 (`class`, `module`, `object_model`, `object_id`)
-                VALUES (%s, 'calendar', %s, %s);""")
-        data = ('humhub\\modules\\calendar\\activities\\ResponseAttend',
-                'humhub\\modules\\calendar\\models\\CalendarEntry',
-                calendarEntryID)
-        cursor.execute(query, data)
-        cnx.commit()
-        activityID = cursor.lastrowid
-
-        query = ("""INSERT INTO `content`
+                VALUES (%s, 'calendar', %s, %s)""",
+            [('humhub\\modules\\calendar\\activities\\ResponseAttend',
+              calendarModel,
+              entryID) for entryID in entryIDs],
+            step)
+
+        insertRows(
+            cursor,
+            """INSERT INTO `content`
                 (`guid`, `object_model`, `object_id`, `visibility`,
                 `pinned`, `archived`, `created_at`, `created_by`,
                 `updated_at`, `updated_by`, `contentcontainer_id`,
                 `stream_sort_date`, `stream_channel`) VALUES
                 (%s, %s, %s, 1, 0, '0', %s, 5, %s, 5, 5, %s,
-                'activity');""")
-        data = (buildGUID(cnx),
-                'humhub\\modules\\activity\\models\\Activity',
-                activityID,
-                datetimeNow,
-                datetimeNow,
-                datetimeNow)
-        cursor.execute(query, data)
+                'activity')""",
+            [(activityGUIDs[i],
+              'humhub\\modules\\activity\\models\\Activity',
+              activityIDs[i],
+              datetimeNow,
+              datetimeNow,
+              datetimeNow) for i in range(len(users))])
+
         cnx.commit()
+    except Exception:
+        # never leave the transaction open on the long-lived connection
+        cnx.rollback()
+        raise
+    finally:
+        cursor.close()
 
+    for user in users:
+        calendarCache.invalidate(user)
     return []
 
 
+def getContainerIDs(cursor, users):
+    """
+    Gets the content container IDs of users
+
+    :param cursor: Mysql Cursor
+    :type cusor: mysql.connector.cursor.MySQLCursor
+    :param users: Humhub User IDs
+    :type users: list
+    :return: Content container ID by user ID
+    :rtype: dict
+    """
+    placeholders = ', '.join('%s' for unused in users)
+    query = ("""SELECT `pk`, `id` FROM `contentcontainer` WHERE
+        `class` = 'humhub\\\\modules\\\\user\\\\models\\\\User' AND
+        `pk` IN ({}) AND `owner_user_id` = `pk`""").format(placeholders)
+    cursor.execute(query, tuple(users))
+    return dict(cursor.fetchall())
+
+
+def getAutoIncrementIncrement(cursor):
+    """
+    Gets the distance between auto increment IDs of the session, more than
+    1 on multi-primary setups like Galera
+
+    :param cursor: Mysql Cursor
+    :type cusor: mysql.connector.cursor.MySQLCursor
+    :rtype: int
+    """
+    cursor.execute("SELECT @@SESSION.auto_increment_increment")
+    return int(cursor.fetchone()[0])
+
+
+def insertRows(cursor, query, rows, step=1):
+    """
+    Inserts rows with one multi-row statement. The statement is built here
+    instead of by executemany, which falls back to one statement per row and
+    then reports the ID of the last row.
+
+    :param cursor: Mysql Cursor
+    :type cusor: mysql.connector.cursor.MySQLCursor
+    :param query: INSERT statement with placeholders for one row
+    :type query: str
+    :param rows: Parameters of each row
+    :type rows: list
+    :param step: auto_increment_increment of the session
+    :type step: int
+    :return: Auto increment IDs of the inserted rows
+    :rtype: list
+    """
+    head, values = query.rsplit('VALUES', 1)
+    statement = head + 'VALUES ' + ', '.join([values.strip()] * len(rows))
+    cursor.execute(statement, tuple(value for row in rows for value in row))
+    if cursor.rowcount != len(rows):
+        raise mysql.connector.DatabaseError(
+            "Inserted {} of {} rows".format(cursor.rowcount, len(rows)))
+    return [cursor.lastrowid + i * step for i in range(len(rows))]
+
+
 def buildGUID(cnx):
     """
     Builds GUID needed for content table in Humhub db
     """
-    unique = 0
-    while (unique == 0):
-        match = None
-        while (match is None):
-            hexstr = str(
-                os.urandom(4).encode('hex') +
-                "-" + os.urandom(2).encode('hex') +
-                "-" + hex(random.randint(0, 0x0fff) | 0x4000)[2:] +
-                "-" + hex(random.randint(0, 0x3fff) | 0x8000)[2:] +
-                "-" + os.urandom(6).encode('hex')
-            )
-            match = re.search(
-                '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}',
-                hexstr
-            )
-        hexstr = "'" + hexstr + "'"
-        # check if GUID is already used
-        cursor = cnx.cursor(buffered=True)
-        query = "SELECT id FROM `content` WHERE guid = {}".format(hexstr)
-        cursor.execute(query)
-        if cursor.rowcount == 0:
-            unique = 1
-        else:
-            unique = 0
-    return hexstr
+    return guidAllocator.allocate(cnx, 1)[0]
+
+
+class GUIDAllocator(object):
+    """
+    Hands out RFC 4122 version 4 GUIDs for the content table. GUIDs are
+    generated locally and checked against the content table in batches with
+    one query, so handing out a GUID usually needs no database round trip.
+    """
+    def __init__(self, batch_size=64):
+        """
+        Initializes the empty pool of verified GUIDs
+
+        :param batch_size: Number of GUIDs verified per query
+        :type batch_size: int
+        """
+        self.batch_size = batch_size
+        self.guids = []
+        self.lock = threading.Lock()
+
+    def allocate(self, cnx, count):
+        """
+        Hands out unused GUIDs
+
+        :param cnx: Connection to check GUIDs with
+        :type cnx: MySQLConnection
+        :param count: Number of GUIDs needed
+        :type count: int
+        :return: GUIDs
+        :rtype: list
+        """
+        with self.lock:
+            while len(self.guids) < count:
+                self.refill(cnx, max(self.batch_size, count - len(self.guids)))
+            guids = self.guids[:count]
+            self.guids = self.guids[count:]
+        return guids
+
+    def refill(self, cnx, count):
+        """
+        Generates count GUIDs and keeps those not used in the content table
+        """
+        candidates = set(str(uuid.uuid4()) for i in range(count))
+        candidates.difference_update(self.guids)
+        placeholders = ', '.join('%s' for unused in candidates)
+        cursor = cnx.cursor()
+        query = "SELECT guid FROM `content` WHERE guid IN ({})".format(
+            placeholders)
+        cursor.execute(query, tuple(candidates))
+        used = set(row[0] for row in cursor.fetchall())
+        cursor.close()
+        self.guids.extend(candidates - used)
+
+
+guidAllocator = GUIDAllocator()
+
+
+class CachedStemmer(object):
+    """
+    Thread-safe memoizing wrapper around a stemmer. Keeps the stems of the
+    maxsize most recently used words.
+    """
+    def __init__(self, stemmer, maxsize=10000):
+        """
+        Initializes the empty cache
+
+        :param stemmer: Stemmer with a stem method, e.g. SnowballStemmer
+        :type stemmer: object
+        :param maxsize: Maximum number of cached words
+        :type maxsize: int
+        """
+        self.stemmer = stemmer
+        self.maxsize = maxsize
+        self.stems = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def stem(self, word):
+        """
+        Returns the stem of a word
+
+        :param word: Word to stem
+        :type word: str
+        :return: Word stem
+        :rtype: str
+        """
+        with self.lock:
+            stem = self.stems.pop(word, None)
+            if stem is not None:
+                self.stems[word] = stem # mark as recently used
+                self.hits += 1
+                return stem
+            self.misses += 1
+        stem = self.stemmer.stem(word)
+        with self.lock:
+            self.stems[word] = stem
+            while len(self.stems) > self.maxsize:
+                self.stems.popitem(last=False)
+        return stem
+
+    def warm(self, terms):
+        """
+        Stems every word of the given terms in advance
+        """
+        for term in terms:
+            for word in term.lower().split():
+                self.stem(word)
+
+    def stats(self):
+        """
+        Returns the cache counters
+
+        :return: Hits, misses and number of cached words
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.stems),
+            }
+
+
+stemmer = CachedStemmer(SnowballStemmer("german"))
+
+
+CompetenceNode = namedtuple('CompetenceNode',
+                            ['competence', 'synonyms', 'subcategories'])
+
+
+class CompetenceTaxonomy(object):
+    """
+    Compiled, read-only form of the competence dictionary. Categories are
+    nested CompetenceNode tuples, so a loaded taxonomy can be shared between
+    threads.
+    """
+    def __init__(self, dictionary):
+        """
+        Compiles the competence dictionary
+
+        :param dictionary: Competences as loaded from competences.json
+        :type dictionary: list
+        """
+        self.categories = compileCompetences(dictionary)
+        self.vocabulary = tuple(getAllCompetences(self.categories))
+        stemmer.warm(self.vocabulary)
+        self.paths = {}
+        self.indexPaths(self.categories, ())
+        self.matcher = CompetenceMatcher(self.paths)
+        self.trigrams = TrigramIndex(self.vocabulary)
+
+    def __iter__(self):
+        return iter(self.categories)
+
+    def indexPaths(self, categories, parents):
+        """
+        Maps every stemmed competence and synonym to its path from searched
+        to general competence. Walks the tree in the order searchCompetence
+        did, so the first match wins on duplicate terms.
+        """
+        for competence in categories:
+            path = (competence.competence,) + parents
+            for term in (competence.competence,) + competence.synonyms:
+                self.paths.setdefault(normalizeCompetence(term), path)
+            self.indexPaths(competence.subcategories, path)
+
+    def search(self, search, threshold=None):
+        """
+        Returns the path for a competence from general competence to searched
+        competence. Unknown terms of at least MIN_SIMILAR_LENGTH characters
+        are looked up by trigram similarity, e.g. for misspelled competences.
+
+        :param search: Searched competence or synonym
+        :type search: str
+        :param threshold: Minimum similarity of a misspelled term, no
+                          similarity search if None
+        :type threshold: float
+        :return: Competence path, most specific first
+        :rtype: list
+        """
+        path = self.paths.get(normalizeCompetence(search))
+        if (path is None and threshold is not None and
+                len(search.strip()) >= MIN_SIMILAR_LENGTH):
+            for (term, similarity) in self.trigrams.search(search, threshold):
+                path = self.paths.get(normalizeCompetence(term))
+                if path is not None:
+                    break
+        if path is None:
+            raise ValueError("Not found")
+        return list(path)
+
+
+class TrigramIndex(object):
+    """
+    Maps character trigrams to the terms containing them, so similar terms
+    are found without comparing the search with every term
+    """
+    def __init__(self, terms):
+        """
+        Builds the trigram postings
+
+        :param terms: Terms to index
+        :type terms: iterable
+        """
+        self.terms = []
+        self.sizes = []
+        self.postings = {}
+        for term in terms:
+            grams = trigrams(term)
+            if len(grams) == 0:
+                continue
+            self.terms.append(term)
+            self.sizes.append(len(grams))
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(len(self.terms) - 1)
+
+    def search(self, search, threshold):
+        """
+        Returns the terms similar to search, most similar first. Similarity
+        is the dice coefficient of both trigram sets.
+
+        :param search: Searched term
+        :type search: str
+        :param threshold: Minimum similarity between 0 and 1
+        :type threshold: float
+        :return: Terms and their similarity
+        :rtype: list
+        """
+        grams = trigrams(search)
+        shared = {}
+        for gram in grams:
+            for term in self.postings.get(gram, ()):
+                shared[term] = shared.get(term, 0) + 1
+        matches = []
+        for term, count in shared.items():
+            similarity = 2. * count / (len(grams) + self.sizes[term])
+            if similarity >= threshold:
+                matches.append((-similarity, term))
+        matches.sort()
+        return [(self.terms[term], -similarity)
+                for (similarity, term) in matches]
+
+
+def trigrams(term):
+    """
+    Returns the character trigrams of all words in a term, words are padded
+    to also weight their beginning and end
+
+    :param term: Term to split
+    :type term: str
+    :return: Trigrams
+    :rtype: set
+    """
+    grams = set()
+    for word in term.lower().split():
+        word = "  " + word + " "
+        for i in range(len(word) - 2):
+            grams.add(word[i:i + 3])
+    return grams
+
+
+class CompetenceMatcher(object):
+    """
+    Finds competences in a message with a single scan. Single word terms
+    are looked up in a set of stems, terms of several words are matched by
+    an Aho-Corasick automaton over word stems.
+    """
+    def __init__(self, terms):
+        """
+        Builds stem set and automaton
+
+        :param terms: Normalized competence terms
+        :type terms: iterable
+        """
+        self.words = set()
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for term in terms:
+            stems = term.split()
+            if len(stems) == 1:
+                self.words.add(stems[0])
+            elif len(stems) > 1:
+                self.addPhrase(stems)
+        self.linkFailures()
+
+    def addPhrase(self, stems):
+        """
+        Adds a phrase of word stems to the trie
+        """
+        state = 0
+        for stem in stems:
+            if stem not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+                self.goto[state][stem] = len(self.goto) - 1
+            state = self.goto[state][stem]
+        self.output[state] = (len(stems),)
+
+    def linkFailures(self):
+        """
+        Sets failure links breadth first and merges outputs of suffix states
+        """
+        states = deque(self.goto[0].values())
+        while states:
+            state = states.popleft()
+            for stem, child in self.goto[state].items():
+                states.append(child)
+                fallback = self.fail[state]
+                while fallback and stem not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(stem, 0)
+                self.output[child] = (self.output[child] +
+                                      self.output[self.fail[child]])
+
+    def match(self, message):
+        """
+        Returns all competences found in the message
+
+        :param message: Message text
+        :type message: str
+        :return: Matching words and phrases in message order, lowercase
+        :rtype: list
+        """
+        matches = []
+        words = []
+        state = 0
+        for word in re.split('[ .!?]', message):
+            word = word.strip().lower()
+            if word == '':
+                state = 0 # phrases do not span punctuation
+                continue
+            stem = stemmer.stem(word)
+            words.append(word)
+            while state and stem not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(stem, 0)
+            for length in self.output[state]:
+                matches.append(' '.join(words[-length:]))
+            if stem in self.words:
+                matches.append(word)
+        return matches
+
+
+def normalizeCompetence(term):
+    """
+    Normalizes a competence term to its lowercase word stems
+
+    :param term: Competence, synonym or search term
+    :type term: str
+    :return: Stems joined by single spaces
+    :rtype: str
+    """
+    return ' '.join(stemmer.stem(word) for word in term.lower().split())
+
+
+def compileCompetences(dictionary):
+    """
+    Converts the competence dictionary to nested CompetenceNode tuples
+
+    :param dictionary: Competences with optional synonyms and subcategories
+    :type dictionary: list
+    :return: Compiled competences
+    :rtype: tuple
+    """
+    return tuple(
+        CompetenceNode(
+            competence['competence'],
+            tuple(competence.get('synonyms', ())),
+            compileCompetences(competence.get('subcategories', ())))
+        for competence in dictionary)
+
+
+class CompetenceStore(object):
+    """
+    Loads the competence taxonomy once and reloads it only after the file
+    modification time changed
+    """
+    def __init__(self, path='competences.json'):
+        """
+        :param path: Path to the competence json file
+        :type path: str
+        """
+        self.path = path
+        self.mtime = None
+        self.taxonomy = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the compiled taxonomy, reloading a changed file
+
+        :return: Competence taxonomy
+        :rtype: CompetenceTaxonomy
+        """
+        mtime = os.stat(self.path).st_mtime
+        with self.lock:
+            if self.taxonomy is None or mtime != self.mtime:
+                with open(self.path) as data_file:
+                    self.taxonomy = CompetenceTaxonomy(json.load(data_file))
+                self.mtime = mtime
+            return self.taxonomy
+
+
+competenceStore = CompetenceStore()
+competenceThreshold = 0.75
+
+
+def configureCompetences(path, threshold=0.75):
+    """
+    Sets the path of the competence json file
+
+    :param path: Path to the competence json file
+    :type path: str
+    :param threshold: Minimum trigram similarity of misspelled competences,
+                      None disables the similarity search
+    :type threshold: float
+    """
+    global competenceThreshold
+    competenceThreshold = threshold
+    with competenceStore.lock:
+        competenceStore.path = path
+        competenceStore.mtime = None
+        competenceStore.taxonomy = None
+
+
+def getCompetences():
+    """
+    Returns the current competence taxonomy
+
+    :return: Competence taxonomy
+    :rtype: CompetenceTaxonomy
+    """
+    return competenceStore.get()
 
 
 def searchCompetence(search, dictionary):
     """
     Returns the path for a competence from general competence to searched
-    competence.
+    competence. Misspelled competences are only found in a
+    CompetenceTaxonomy, a plain dictionary is searched for exact terms.
     """
-    for competence in dictionary:
-        if (
-            (
-                'competence' in competence and
-                stemmer.stem(competence['competence'])
-                == stemmer.stem(search.lower())
-            )
-            or
-            (
-                'synonyms' in competence and
-                stemmer.stem(search.lower()) in [
-                    stemmer.stem(syn) for syn in competence['synonyms']
-                ]
-            )
-        ):
-            return [competence['competence']]
-        else:
-            try:
-                if 'subcategories' in competence:
-                    return (
-                        searchCompetence(search, competence['subcategories']) +
-                        [competence['competence']])
-            except ValueError:
-                pass
-    raise ValueError("Not found")
+    if not isinstance(dictionary, CompetenceTaxonomy):
+        return CompetenceTaxonomy(dictionary).search(search)
+    return dictionary.search(search, competenceThreshold)
 
 
 def getUserCompetencies(cnx, exceptUserIDs):
@@ -800,22 +2732,82 @@ def getUserCompetencies(cnx, exceptUserIDs):
     Returns array of persons with their competences as values
     """
     competencies = {}
-    cnx = establishDBConnection(dbconfig)
-    cursor = cnx.cursor()
-    placeholder = '%s'
-    placeholders = ', '.join(placeholder for unused in exceptUserIDs)
-    query = ("""SELECT firstname, lastname, competence FROM profile
-             WHERE user_id NOT IN ({}) AND competence IS NOT NULL
-             """).format(placeholders)
-    cursor.execute(query, tuple(exceptUserIDs))
-    cnx.close()
-    for (firstname, lastname, competence) in cursor:
-        competencies[firstname + " " + lastname] = (
-            [comp.strip().lower() for comp in competence.split(',')]
-        )
+    with connectionPool.connection() as cnx:
+        for (user_id, username, competences, updated_at) in (
+                streamUserCompetencies(cnx, exceptUserIDs)):
+            competencies[username] = list(competences)
     return competencies
 
 
+def fetchChunks(cursor, chunk_size):
+    """
+    Yields the rows of an executed query in chunks, so an unbuffered cursor
+    never holds more than chunk_size rows on the client
+
+    :param cursor: Cursor with executed query
+    :type cursor: mysql.connector.cursor.MySQLCursor
+    :param chunk_size: Rows fetched at once
+    :type chunk_size: int
+    """
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+def streamUserCompetencies(cnx, exceptUserIDs=(), since=None,
+                           chunk_size=500):
+    """
+    Streams the competences of all profiles with an unbuffered cursor.
+    The cursor is busy until the generator is exhausted or closed, rows left
+    unread are consumed on close.
+
+    :param cnx: Connection to read profiles with
+    :type cnx: MySQLConnection
+    :param exceptUserIDs: Users to skip
+    :type exceptUserIDs: list
+    :param since: Only profiles updated at or after this date, all if None
+    :type since: datetime
+    :param chunk_size: Rows fetched at once
+    :type chunk_size: int
+    :return: Generator of user ID, user name, normalized competences and
+             update date
+    :rtype: generator
+    """
+    query = ("""SELECT user_id, firstname, lastname, competence, updated_at
+             FROM profile""")
+    conditions = []
+    data = []
+    if since is None:
+        conditions.append("competence IS NOT NULL")
+    else:
+        # second resolution, rows of the watermark second are read again
+        conditions.append("updated_at >= %s")
+        data.append(since)
+    if len(exceptUserIDs) > 0:
+        conditions.append("user_id NOT IN ({})".format(
+            ', '.join('%s' for unused in exceptUserIDs)))
+        data.extend(exceptUserIDs)
+    query += " WHERE " + " AND ".join(conditions)
+    cursor = cnx.cursor(buffered=False)
+    try:
+        cursor.execute(query, tuple(data))
+        for rows in fetchChunks(cursor, chunk_size):
+            for (user_id, firstname, lastname, competence, updated_at) in rows:
+                yield (user_id,
+                       (firstname or '') + " " + (lastname or ''),
+                       splitCompetences(competence),
+                       updated_at)
+    finally:
+        # a consumer stopping early leaves unread rows on the connection
+        try:
+            cnx.consume_results()
+            cursor.close()
+        except mysql.connector.Error as err:
+            logger.warning("Closing profile stream failed: %s", err)
+
+
 def getUsersWithCompetencies(categories, usercompetencies):
     """
     Lists competences and their corresponding user IDs and returns the user ID
@@ -846,31 +2838,171 @@ def getUsersWithCompetencies(categories, usercompetencies):
     return None
 
 
+class CompetenceIndex(object):
+    """
+    Inverted index from competence to the users having it. All profiles are
+    loaded once, afterwards only profiles changed since the last refresh are
+    read again.
+    """
+    def __init__(self, refresh_interval=60):
+        """
+        Initializes the empty index
+
+        :param refresh_interval: Seconds between refreshes from the database
+        :type refresh_interval: float
+        """
+        self.refresh_interval = refresh_interval
+        self.users = {}
+        self.competences = {}
+        self.updated = None
+        self.refreshed = None
+        self.lock = threading.RLock()
+
+    def refresh(self, cnx, force=False):
+        """
+        Loads all profiles on first use, afterwards only profiles changed
+        since the last refresh
+
+        :param cnx: Connection to read profiles with
+        :type cnx: MySQLConnection
+        :param force: Refresh even if the refresh interval did not pass
+        :type force: bool
+        """
+        with self.lock:
+            if (not force and self.refreshed is not None and
+                    time() - self.refreshed < self.refresh_interval):
+                return
+            if self.refreshed is None:
+                profiles = streamUserCompetencies(cnx)
+            else:
+                profiles = streamUserCompetencies(cnx, since=self.updated)
+            for (user_id, username, competences, updated_at) in profiles:
+                self.add(user_id, username, competences)
+                if updated_at is not None and (self.updated is None or
+                                               updated_at > self.updated):
+                    self.updated = updated_at
+            self.refreshed = time()
+
+    def add(self, user_id, username, competences):
+        """
+        Adds or replaces the competences of a user
+        """
+        with self.lock:
+            self.remove(user_id)
+            if len(competences) == 0:
+                return
+            self.users[user_id] = (username, competences)
+            for competence in competences:
+                self.competences.setdefault(competence, set()).add(user_id)
+
+    def remove(self, user_id):
+        """
+        Removes a user from the index
+        """
+        with self.lock:
+            if user_id not in self.users:
+                return
+            for competence in self.users.pop(user_id)[1]:
+                self.competences[competence].discard(user_id)
+                if len(self.competences[competence]) == 0:
+                    del self.competences[competence]
+
+    def find(self, cnx, categories, exceptUserIDs):
+        """
+        Returns the users having the most specific of the given competences
+
+        :param cnx: Connection to refresh the index with
+        :type cnx: MySQLConnection
+        :param categories: Competence path, most specific first
+        :type categories: list
+        :param exceptUserIDs: Users not to return, e.g. the asking users
+        :type exceptUserIDs: list
+        :return: Competence and user names or None if nobody matches
+        :rtype: dict
+        """
+        self.refresh(cnx)
+        exceptUserIDs = set(exceptUserIDs)
+        with self.lock:
+            for competence in categories:  # from special to general
+                users = self.competences.get(competence.strip().lower(), ())
+                users = sorted(user for user in users
+                               if user not in exceptUserIDs)
+                if len(users) > 0:
+                    return {
+                        "competence": competence,
+                        "users": [self.users[user][0] for user in users]
+                    }
+        return None
+
+
+competenceIndex = CompetenceIndex()
+
+
+def configureCompetenceIndex(refresh_interval):
+    """
+    Sets the refresh interval of the competence index
+
+    :param refresh_interval: Seconds between refreshes from the database
+    :type refresh_interval: float
+    """
+    competenceIndex.refresh_interval = refresh_interval
+
+
+def splitCompetences(competence):
+    """
+    Splits a comma separated profile competence field
+
+    :param competence: Competence field, may be None
+    :type competence: str
+    :return: Normalized competences
+    :rtype: tuple
+    """
+    if competence is None:
+        return ()
+    return tuple(comp.strip().lower() for comp in competence.split(',')
+                 if comp.strip() != '')
+
+
+def findCompetentUsers(categories, exceptUserIDs):
+    """
+    Returns the users having the most specific of the given competences
+
+    :param categories: Competence path, most specific first
+    :type categories: list
+    :param exceptUserIDs: Users not to return, e.g. the asking users
+    :type exceptUserIDs: list
+    :return: Competence and user names or None if nobody matches
+    :rtype: dict
+    """
+    with connectionPool.connection() as cnx:
+        return competenceIndex.find(cnx, categories, exceptUserIDs)
+
+
 def getMatchingCompetence(dictionary, lastmessage):
     """
     Searches for a competence in a string
     """
-    allCompetences = getAllCompetences(dictionary)
-    searchedCompetence = []
-    for word in re.split('[ .!?]', lastmessage):
-        if stemmer.stem(word.strip().lower()) in [
-                stemmer.stem(comp) for comp in allCompetences]:
-            searchedCompetence.append(word.strip().lower())
-    return searchedCompetence
+    if not isinstance(dictionary, CompetenceTaxonomy):
+        dictionary = CompetenceTaxonomy(dictionary)
+    return dictionary.matcher.match(lastmessage)
 
 
-def getAllCompetences(dictionary, competences=[]):
+def getAllCompetences(dictionary, competences=None):
     """
     Gets all competences and synonyms in competence dictionary without
     hirarchical list
     """
+    if competences is None:
+        competences = []
+    if isinstance(dictionary, CompetenceTaxonomy):
+        competences.extend(dictionary.vocabulary)
+        return competences
+    if not isinstance(dictionary, tuple):
+        dictionary = compileCompetences(dictionary)
     for competence in dictionary:
-        competences.append(competence['competence'])
-        if 'synonyms' in competence:
-            for synonym in competence['synonyms']:
-                competences.append(synonym)
-        if 'subcategories' in competence:
-            getAllCompetences(competence['subcategories'], competences)
+        competences.append(competence.competence)
+        competences.extend(competence.synonyms)
+        getAllCompetences(competence.subcategories, competences)
     return competences
 
 def getUserID(person):
@@ -895,19 +3027,6 @@ def getUserID(person):
     global offlinemode
     if offlinemode:
         return 8
-    # search in humhub db
-    cnx = establishDBConnection(dbconfig)
-    cursor = cnx.cursor()
-    query = ''
-    if firstname == '':
-        query = ("""SELECT user_id FROM profile WHERE lastname = {}
-                """).format(lastname)
-    else:
-        query = ("""SELECT user_id FROM profile WHERE firstname = {}
-                    AND lastname = {}
-                """).format(firstname, lastname)
-    cursor.execute(query)
-    for user_id in cursor:
-        userid = user_id
-    cnx.close()
-    return userid
+    # search in profile directory, loaded from humhub db
+    with connectionPool.connection() as cnx:
+        return profileDirectory.getID(cnx, firstname, lastname)
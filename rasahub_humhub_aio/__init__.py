@@ -0,0 +1,204 @@
+"""
+Asyncio variant of the Humhub connector, requires Python 3 and aiomysql
+(pip install rasahub-humhub[async]). Rasahub loads the plugin class of a
+top-level package, so the connector has its own package and wraps the
+blocking HumhubConnector instead of subclassing it.
+"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import aiomysql
+from rasahub import RasahubPlugin
+
+import rasahub_humhub
+from rasahub_humhub.humhub import (botConversationsQuery, replyQuery,
+                                   scanMessagesQuery)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncHumhubConnector(RasahubPlugin):
+    """
+    AsyncHumhubConnector receives and sends messages through aiomysql on its
+    own event loop and runs commands concurrently, so slow calendar searches
+    do not block message ingestion or sending
+    """
+    # receiving and sending share a small aiomysql pool, the rest of
+    # pool_max_size is left to the commands
+    loop_connections = 2
+    def __init__(self,
+                 host = '127.0.0.1',
+                 dbname = 'humhub',
+                 port = 3306,
+                 dbuser = 'user',
+                 dbpasswd = '',
+                 trigger = '!bot',
+                 pool_max_size = 10,
+                 command_workers = 4,
+                 **kwargs):
+        """
+        Initializes the blocking connector state and the asyncio settings,
+        further keyword arguments are passed to HumhubConnector
+
+        :param pool_max_size: maximum number of open database connections,
+                              at least 4
+        :type state: int.
+        :param command_workers: number of commands processed concurrently
+        :type state: int.
+        """
+        super(AsyncHumhubConnector, self).__init__()
+        if int(pool_max_size) < 4:
+            raise ValueError("pool_max_size must be at least 4, "
+                             "got {}".format(pool_max_size))
+        # the blocking connector only runs commands and holds no connections
+        self.connector = rasahub_humhub.HumhubConnector(
+            host, dbname, port, dbuser, dbpasswd, trigger,
+            pool_max_size = int(pool_max_size) - self.loop_connections,
+            hold_connections = False,
+            **kwargs)
+        self.dbargs = {
+            'host': host,
+            'port': int(port),
+            'user': dbuser,
+            'password': dbpasswd,
+            'db': dbname,
+            'autocommit': True,
+        }
+        self.command_workers = max(int(command_workers), 1)
+        self.loop = None
+        self.loop_thread = None
+        self.executor = None
+        self.apool = None
+        self.loop_lock = threading.Lock()
+
+    def start_loop(self):
+        """
+        Starts the event loop thread and the command workers on first use, so
+        the connector can be handed to a worker process before any thread
+        exists
+        """
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.executor = ThreadPoolExecutor(self.command_workers)
+                self.loop_thread = threading.Thread(
+                    target=self.loop.run_forever)
+                self.loop_thread.daemon = True
+                self.loop_thread.start()
+        return self.loop
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine on the connector loop and waits for its result
+        """
+        loop = self.start_loop()
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    async def get_pool(self):
+        """
+        Creates the aiomysql pool on the connector loop
+        """
+        if self.apool is None:
+            self.apool = await aiomysql.create_pool(
+                minsize=1,
+                maxsize=self.loop_connections,
+                **self.dbargs)
+        return self.apool
+
+    async def areceive(self):
+        """
+        Coroutine variant of receive
+
+        :returns: dictionary - Received message with conversation ID
+        """
+        connector = self.connector
+        if not connector.pending:
+            await asyncio.sleep(connector.scheduler.delay())
+        if not connector.pending and connector.scheduler.due():
+            query, data = scanMessagesQuery(connector.scan_id,
+                                            connector.bot_id,
+                                            connector.batch_size)
+            pool = await self.get_pool()
+            async with pool.acquire() as cnx:
+                async with cnx.cursor() as cursor:
+                    await cursor.execute(query, data)
+                    rows = await cursor.fetchall()
+                    unknown = connector.unknown_conversations(rows)
+                    if unknown:
+                        query, data = botConversationsQuery(
+                            connector.bot_id, unknown)
+                        await cursor.execute(query, data)
+                        connector.add_conversations(await cursor.fetchall())
+            connector.add_pending(rows)
+        return connector.next_pending()
+
+    async def asend(self, messagedata):
+        """
+        Coroutine variant of send
+        """
+        query, data = replyQuery(messagedata.message_id,
+                                 self.connector.bot_id,
+                                 messagedata.message)
+        pool = await self.get_pool()
+        async with pool.acquire() as cnx:
+            async with cnx.cursor() as cursor:
+                await cursor.execute(query, data)
+
+    def command_done(self, future):
+        """
+        Hands the reply of a finished command on like rasahub's out thread
+        does with a returned reply
+        """
+        try:
+            reply = future.result()
+        except Exception:
+            logger.exception("Command failed")
+            return
+        if reply is None:
+            return
+        if reply.target == self.name:
+            self.send(reply, self.main_queue)
+        else:
+            self.main_queue.put(reply)
+
+    def receive(self):
+        """
+        Implements receive function
+        """
+        return self.run(self.areceive())
+
+    def send(self, messagedata, main_queue):
+        """
+        Saves reply message from Rasa_Core to db
+        """
+        if self.connector.reply_buffer is not None:
+            return self.connector.send(messagedata, main_queue)
+        self.run(self.asend(messagedata))
+
+    def process_command(self, command, payload, out_message):
+        """
+        Starts the command on a worker thread and returns without a reply,
+        the reply is handed on as soon as the command finished. Each command
+        borrows its own pooled connection.
+        """
+        self.start_loop()
+        future = self.executor.submit(self.connector.process_command,
+                                      command, payload, out_message)
+        future.add_done_callback(self.command_done)
+        return None
+
+    def end(self):
+        """
+        Waits for running commands, closes aiomysql pool, event loop and
+        mysql connections
+        """
+        if self.loop is not None:
+            self.executor.shutdown()
+            if self.apool is not None:
+                self.apool.close()
+                self.run(self.apool.wait_closed())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+        self.connector.end()
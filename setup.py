@@ -13,7 +13,9 @@ tests_requires = [
 ]
 
 extras_requires = {
-    'test': tests_requires
+    'test': tests_requires,
+    'async': ['aiomysql'],
+    'numpy': ['numpy'],
 }
 
 setup(name='rasahub-humhub',
@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import rasahub
+from rasahub.message import RasahubMessage
+
+import rasahub_humhub.humhub as humhub
+from rasahub_humhub.humhub import queue
+from tests.test_connector import FakeConnection, humhubResponder
+
+try:
+    import rasahub_humhub_aio
+except (ImportError, SyntaxError): # Python 2 cannot parse async def
+    rasahub_humhub_aio = None
+
+
+@unittest.skipIf(rasahub_humhub_aio is None, "aiomysql not installed")
+class AsyncConnectorTest(unittest.TestCase):
+    def setUp(self):
+        self.connectToDB = humhub.connectToDB
+        humhub.connectToDB = lambda *args: FakeConnection(humhubResponder)
+
+    def tearDown(self):
+        humhub.connectToDB = self.connectToDB
+
+    def test_loadPlugin(self):
+        directory = tempfile.mkdtemp()
+        configpath = os.path.join(directory, 'config.yml')
+        with open(configpath, 'w') as config:
+            config.write("humhub:\n"
+                         "  package: 'rasahub_humhub_aio'\n"
+                         "  type: 'interface'\n"
+                         "  out: 'rasa'\n"
+                         "  init:\n"
+                         "    command_workers: 2\n")
+        try:
+            handler = rasahub.initialize_middleware(configpath)
+        finally:
+            shutil.rmtree(directory)
+        plugin = handler.plugins['interface']['humhub']
+        self.assertIsInstance(plugin, rasahub_humhub_aio.AsyncHumhubConnector)
+        self.assertEqual(plugin.command_workers, 2)
+        plugin.end()
+
+    def test_connections(self):
+        plugin = rasahub_humhub_aio.AsyncHumhubConnector(pool_max_size=6)
+        self.assertIsNone(plugin.connector.cnx_in)
+        self.assertIsNone(plugin.connector.cnx_out)
+        self.assertIsNone(plugin.connector.cnx_processing)
+        self.assertEqual(plugin.connector.pool.max_size, 4)
+        self.assertRaises(ValueError, rasahub_humhub_aio.AsyncHumhubConnector,
+                          pool_max_size=3)
+        plugin.end()
+
+    def test_processCommandConcurrently(self):
+        plugin = rasahub_humhub_aio.AsyncHumhubConnector(command_workers=2)
+        plugin.set_name('humhub')
+        plugin.main_queue = queue.Queue()
+        started = threading.Barrier(3)
+
+        def run_command(command, payload, cursor):
+            started.wait(5) # both commands run at the same time
+            return RasahubMessage(message = command,
+                                  message_id = payload['message_id'],
+                                  target = 'rasa',
+                                  source = 'humhub')
+        plugin.connector.run_command = run_command
+
+        for command in ('first', 'second'):
+            self.assertIsNone(plugin.process_command(
+                command, {'message_id': 1}, None))
+        started.wait(5)
+        replies = [plugin.main_queue.get(timeout=5) for i in range(2)]
+        self.assertEqual(sorted(reply.message for reply in replies),
+                         ['first', 'second'])
+        plugin.end()
+
+
+if __name__ == '__main__':
+    unittest.main()
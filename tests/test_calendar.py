@@ -0,0 +1,288 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import re
+import threading
+import unittest
+
+import mysql.connector
+
+import rasahub_humhub.humhub as humhub
+from rasahub_humhub.humhub import *
+from datetime import date, datetime, time
+from time import time as now
+from tests.test_connector import FakeConnection, humhubResponder
+
+
+class CalendarTest(unittest.TestCase):
+    dates = {
+        'a': {'start': '2018-05-24T08:10:00', 'end': '2018-05-24T09:00:00'},
+        'b': {'start': '2018-05-24T09:30:00', 'end': '2018-05-24T10:05:00'},
+    }
+
+    def test_busyMask(self):
+        mask = busyMask(self.dates)
+        # 08:00 - 09:00 and 09:30 - 10:15
+        self.assertEqual(mask, slotRangeMask(32, 36) | slotRangeMask(38, 41))
+
+    def test_patternRoundTrip(self):
+        pattern = setBusyDates(createCalendarPattern(), self.dates)
+        self.assertEqual(pattern[8], [1, 1, 1, 1])
+        self.assertEqual(pattern[9], [0, 0, 1, 1])
+        self.assertEqual(pattern[10], [1, 0, 0, 0])
+        self.assertEqual(maskToPattern(patternToMask(pattern)), pattern)
+
+    def test_matchCalendars(self):
+        first = maskToPattern(slotRangeMask(0, 4))
+        second = maskToPattern(slotRangeMask(92, 96))
+        self.assertEqual(patternToMask(matchCalendars([first, None, second])),
+                         slotRangeMask(0, 4) | slotRangeMask(92, 96))
+
+    def test_getDateSuggestion(self):
+        pattern = setBusyDates(createCalendarPattern(), self.dates)
+        self.assertEqual(getDateSuggestion(pattern, 60, 0, 7, 0, 19, 3),
+                         [7, 0])
+        self.assertEqual(getDateSuggestion(pattern, 30, 1, 8, 0, 19, 3),
+                         [10, 15])
+        self.assertEqual(getDateSuggestion(pattern, 60, 0, 9, 0, 10, 3),
+                         [0])
+        self.assertEqual(getDateSuggestion(pattern, 0, 0, 9, 0, 10, 3),
+                         [9, 0])
+
+    def test_bucketBusyMasks(self):
+        intervals = calendarIntervals(self.dates) + [
+            (datetime(2018, 5, 24, 23, 0), datetime(2018, 5, 25, 1, 20)),
+            (datetime(2018, 5, 27, 9, 0), datetime(2018, 5, 27, 10, 0)),
+        ]
+        masks = bucketBusyMasks(intervals, date(2018, 5, 24),
+                                date(2018, 5, 25))
+        self.assertEqual(sorted(masks), [date(2018, 5, 24), date(2018, 5, 25)])
+        self.assertEqual(masks[date(2018, 5, 24)],
+                         busyMask(self.dates) | slotRangeMask(92, 96))
+        self.assertEqual(masks[date(2018, 5, 25)], slotRangeMask(0, 6))
+
+    def test_calendarCache(self):
+        cache = CalendarCache(ttl=60, maxsize=2)
+        cache.put(1, date(2018, 5, 24), 3)
+        cache.put(2, date(2018, 5, 24), 5)
+        self.assertEqual(cache.get(1, date(2018, 5, 24)), 3)
+        cache.put(3, date(2018, 5, 24), 7) # evicts user 2
+        self.assertIsNone(cache.get(2, date(2018, 5, 24)))
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1, date(2018, 5, 24)))
+        self.assertEqual(cache.get(3, date(2018, 5, 24)), 7)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 2, 'size': 1})
+        cache.ttl = -1
+        cache.put(3, date(2018, 5, 24), 7)
+        self.assertIsNone(cache.get(3, date(2018, 5, 24)))
+
+    def test_getCalendars(self):
+        calendarItems = {
+            1: self.dates,
+            2: {'c': {'start': '2018-05-25T12:00:00',
+                      'end': '2018-05-25T13:00:00'}},
+        }
+        humhub.get_google_calendar_items = lambda user: calendarItems[user]
+        calendarCache.clear()
+        try:
+            calendars = getCalendars([1, 2], datetime(2018, 5, 24, 7),
+                                     datetime(2018, 5, 25, 19), None)
+        finally:
+            del humhub.get_google_calendar_items
+        self.assertEqual(calendars[1][date(2018, 5, 24)], busyMask(self.dates))
+        self.assertEqual(calendars[1][date(2018, 5, 25)], 0)
+        self.assertEqual(calendars[2][date(2018, 5, 25)], slotRangeMask(48, 52))
+        self.assertEqual(calendarCache.get(2, date(2018, 5, 25)),
+                         ((datetime(2018, 5, 25, 12), datetime(2018, 5, 25, 13)),))
+
+    def test_getCalendarsTimeout(self):
+        released = threading.Event()
+
+        def calendarItems(user):
+            if user < 10:
+                released.wait(10) # hangs
+            return {}
+        humhub.get_google_calendar_items = calendarItems
+        calendarCache.clear()
+        configureCalendarWorkers(8, 0.5)
+        try:
+            started = now()
+            with self.assertRaises(CalendarTimeoutError) as error:
+                getCalendarIntervals(list(range(8)), datetime(2018, 5, 24, 7),
+                                     datetime(2018, 5, 25, 19), None)
+            self.assertLess(now() - started, 1.5)
+            self.assertEqual(error.exception.users, list(range(8)))
+            # hung fetches do not block the workers of the next search
+            calendars = getCalendarIntervals([10, 11],
+                                             datetime(2018, 5, 24, 7),
+                                             datetime(2018, 5, 25, 19), None)
+            self.assertEqual(sorted(calendars), [10, 11])
+        finally:
+            released.set()
+            configureCalendarWorkers(8, 10)
+            del humhub.get_google_calendar_items
+
+    def test_getCalendarsNotAuthenticated(self):
+        def calendarItems(user):
+            if user != 2:
+                raise Exception("No credentials")
+            return self.dates
+        humhub.get_google_calendar_items = calendarItems
+        calendarCache.clear()
+        cnx = FakeConnection(humhubResponder)
+        try:
+            with self.assertRaises(NotAuthenticatedError) as error:
+                getCalendarIntervals([1, 2, 3], datetime(2018, 5, 24, 7),
+                                     datetime(2018, 5, 25, 19), cnx.cursor())
+        finally:
+            del humhub.get_google_calendar_items
+        self.assertEqual(sorted(error.exception.users), [1, 3])
+        # one auth link conversation per unauthenticated user
+        self.assertEqual(len([query for (query, data) in cnx.queries
+                              if query.startswith("INSERT INTO message ")]),
+                         2)
+
+    def test_mergeIntervals(self):
+        merged = mergeIntervals([
+            (datetime(2018, 5, 24, 10), datetime(2018, 5, 24, 11)),
+            (datetime(2018, 5, 24, 8), datetime(2018, 5, 24, 9)),
+            (datetime(2018, 5, 24, 9), datetime(2018, 5, 24, 9, 30)),
+            (datetime(2018, 5, 24, 10, 15), datetime(2018, 5, 24, 10, 45)),
+        ])
+        self.assertEqual(merged, [
+            (datetime(2018, 5, 24, 8), datetime(2018, 5, 24, 9, 30)),
+            (datetime(2018, 5, 24, 10), datetime(2018, 5, 24, 11)),
+        ])
+
+    def test_findFreeSlots(self):
+        busy = calendarIntervals(self.dates)
+        slots = findFreeSlots(busy,
+                              datetime(2018, 5, 24, 7, 50),
+                              datetime(2018, 5, 26),
+                              30, time(8), time(11), 15, count=3)
+        self.assertEqual(slots, [datetime(2018, 5, 24, 9, 0),
+                                 datetime(2018, 5, 24, 10, 15),
+                                 datetime(2018, 5, 25, 8, 0)])
+        slots = findFreeSlots(busy,
+                              datetime(2018, 5, 24, 7, 50),
+                              datetime(2018, 5, 26),
+                              30, time(8), time(11), 5, skip=1)
+        self.assertEqual(slots, [datetime(2018, 5, 24, 10, 5)])
+
+    def test_findFreeSlotsOverMidnight(self):
+        busy = [(datetime(2018, 5, 24, 22), datetime(2018, 5, 24, 23, 30))]
+        slots = findFreeSlots(busy,
+                              datetime(2018, 5, 24, 21),
+                              datetime(2018, 5, 25, 12),
+                              60, time(22), time(2), 15)
+        self.assertEqual(slots, [datetime(2018, 5, 24, 23, 30)])
+
+    @unittest.skipIf(numpy is None, "NumPy not installed")
+    def test_getFreeSlotMatrix(self):
+        busy = numpy.zeros((2, 2, SLOTS_PER_DAY), dtype=bool)
+        busy[0, 0] = maskToArray(busyMask(self.dates))
+        busy[1, 0, 28:32] = True # 07:00 - 08:00
+        busy[1, 1, 28:40] = True # 07:00 - 10:00
+        self.assertEqual(getFreeSlotMatrix(busy, 2, 0, 28, 76), (0, 36))
+        self.assertEqual(getFreeSlotMatrix(busy, 2, 1, 28, 76), (0, 41))
+        self.assertEqual(getFreeSlotMatrix(busy, 56, 0, 28, 76), (1, 40))
+        self.assertIsNone(getFreeSlotMatrix(busy, 97, 0, 28, 76))
+
+    @unittest.skipIf(numpy is None, "NumPy not installed")
+    def test_maskToArray(self):
+        mask = slotRangeMask(3, 5) | slotRangeMask(90, 96)
+        self.assertEqual(list(numpy.flatnonzero(maskToArray(mask))),
+                         [3, 4, 90, 91, 92, 93, 94, 95])
+
+
+class BookingDB(object):
+    """
+    Auto increment tables of a node with auto_increment_increment 2
+    answering the booking queries
+    """
+    def __init__(self, failing=None, error=None, short=None):
+        self.failing = failing
+        self.error = error or mysql.connector.Error("Deadlock found")
+        self.short = short
+        self.lastrowid = None
+        self.rowcount = -1
+        self.nextIDs = {}
+        self.tables = {}
+
+    def __call__(self, query, data):
+        self.rowcount = -1
+        if query.startswith("SELECT `pk`, `id` FROM `contentcontainer`"):
+            return [(user, user + 100) for user in data]
+        if query == "SELECT @@SESSION.auto_increment_increment":
+            return [(2,)]
+        if query.startswith("INSERT INTO"):
+            table = re.match(r"INSERT INTO `?(\w+)", query).group(1)
+            if table == self.failing:
+                raise self.error
+            count = query.split('VALUES', 1)[1].count('(')
+            width = len(data) // count
+            rows = [tuple(data[i * width:(i + 1) * width])
+                    for i in range(count)]
+            self.lastrowid = self.nextIDs.get(table, 11)
+            self.nextIDs[table] = self.lastrowid + 2 * count
+            self.tables.setdefault(table, []).extend(rows)
+            self.rowcount = count - 1 if table == self.short else count
+        return []
+
+
+class BookDateTest(unittest.TestCase):
+    def setUp(self):
+        humhub.offlinemode = True
+
+    def tearDown(self):
+        humhub.offlinemode = False
+
+    def test_bookdate(self):
+        db = BookingDB()
+        cnx = FakeConnection(db)
+        self.assertEqual(bookdate(cnx, datetime(2018, 5, 24, 9), 30,
+                                  [2, 3, 4]), [])
+        self.assertEqual(cnx.transactions, ['start', 'commit'])
+        self.assertEqual(db.tables['calendar_entry_participant'],
+                         [(11, 2), (13, 3), (15, 4)])
+        self.assertEqual([row[1] for row in db.tables['user_follow']],
+                         [11, 13, 15])
+        # the first activities belong to the entries, then the responses
+        self.assertEqual([row[2] for row in db.tables['activity']],
+                         [11, 13, 15, 11, 13, 15])
+        content = db.tables['content']
+        self.assertEqual([row[2] for row in content[:3]], [11, 13, 15])
+        self.assertEqual([row[5] for row in content[:3]], [102, 103, 104])
+        self.assertEqual([row[2] for row in content[3:]], [17, 19, 21])
+        self.assertEqual(len(set(row[0] for row in content)), 6)
+
+    def test_bookdateRollback(self):
+        db = BookingDB(failing='user_follow')
+        cnx = FakeConnection(db)
+        calendarCache.put(2, date(2018, 5, 24), ())
+        self.assertRaises(mysql.connector.Error, bookdate, cnx,
+                          datetime(2018, 5, 24, 9), 30, [2, 3])
+        self.assertEqual(cnx.transactions, ['start', 'rollback'])
+        # nothing was booked, the cached calendar stays valid
+        self.assertEqual(calendarCache.get(2, date(2018, 5, 24)), ())
+
+    def test_bookdateRollbackOnAnyError(self):
+        db = BookingDB(failing='content', error=KeyError('guid'))
+        cnx = FakeConnection(db)
+        self.assertRaises(KeyError, bookdate, cnx,
+                          datetime(2018, 5, 24, 9), 30, [2, 3])
+        self.assertEqual(cnx.transactions, ['start', 'rollback'])
+
+    def test_bookdateMissingRows(self):
+        db = BookingDB(short='calendar_entry')
+        cnx = FakeConnection(db)
+        self.assertRaises(mysql.connector.Error, bookdate, cnx,
+                          datetime(2018, 5, 24, 9), 30, [2, 3])
+        self.assertEqual(cnx.transactions, ['start', 'rollback'])
+        self.assertNotIn('activity', db.tables)
+
+
+if __name__ == '__main__':
+    unittest.main()
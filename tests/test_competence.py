@@ -0,0 +1,160 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from rasahub_humhub.humhub import *
+from tests.test_connector import FakeConnection
+
+
+COMPETENCES = [
+    {
+        'competence': 'informatik',
+        'synonyms': ['it'],
+        'subcategories': [
+            {
+                'competence': 'programmierung',
+                'subcategories': [
+                    {'competence': 'python', 'synonyms': ['django']},
+                    {'competence': 'java'},
+                ],
+            },
+            {'competence': 'datenbanken', 'synonyms': ['mysql']},
+        ],
+    },
+    {
+        'competence': 'marketing',
+        'synonyms': ['werbung'],
+    },
+]
+
+
+class CompetenceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'competences.json')
+        self.write(COMPETENCES)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, competences, mtime=None):
+        with open(self.path, 'w') as data_file:
+            json.dump(competences, data_file)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_searchCompetence(self):
+        taxonomy = CompetenceTaxonomy(COMPETENCES)
+        self.assertEqual(searchCompetence('Django', taxonomy),
+                         ['python', 'programmierung', 'informatik'])
+        self.assertEqual(searchCompetence('mysql', COMPETENCES),
+                         ['datenbanken', 'informatik'])
+        self.assertRaises(ValueError, searchCompetence, 'kochen', taxonomy)
+
+    def test_searchCompetenceFirstMatch(self):
+        taxonomy = CompetenceTaxonomy([
+            {'competence': 'technik', 'subcategories': [
+                {'competence': 'daten', 'synonyms': ['big data']}]},
+            {'competence': 'Big  Data'},
+        ])
+        self.assertEqual(taxonomy.search('BIG DATA'), ['daten', 'technik'])
+        self.assertEqual(taxonomy.search('technik'), ['technik'])
+
+    def test_searchCompetenceSimilar(self):
+        taxonomy = CompetenceTaxonomy(COMPETENCES)
+        self.assertEqual(searchCompetence('Programierung', taxonomy),
+                         ['programmierung', 'informatik'])
+        self.assertEqual(taxonomy.search('Pyhton', 0.4),
+                         ['python', 'programmierung', 'informatik'])
+        self.assertRaises(ValueError, taxonomy.search, 'Pyhton')
+        self.assertRaises(ValueError, taxonomy.search, 'Pyhton', 0.9)
+        # the legacy dictionary search only finds exact terms
+        self.assertRaises(ValueError, searchCompetence, 'Programierung',
+                          COMPETENCES)
+
+    def test_searchCompetenceNotSimilar(self):
+        taxonomy = CompetenceTaxonomy(COMPETENCES + [
+            {'competence': 'machine learning',
+             'synonyms': ['maschinelles lernen']},
+        ])
+        for search in ('Marktforschung', 'Informationen', 'Lernen', 'Ja'):
+            self.assertRaises(ValueError, searchCompetence, search, taxonomy)
+        self.assertRaises(ValueError, taxonomy.search, 'Ja', 0.4)
+
+    def test_trigramIndex(self):
+        index = TrigramIndex(['python', 'java', 'javascript'])
+        matches = index.search('javscript', 0.3)
+        self.assertEqual([term for (term, similarity) in matches],
+                         ['javascript', 'java'])
+        self.assertEqual(index.search('kochen', 0.3), [])
+
+    def test_getMatchingCompetence(self):
+        taxonomy = CompetenceTaxonomy(COMPETENCES + [
+            {'competence': 'machine learning', 'synonyms': ['deep learning'],
+             'subcategories': [{'competence': 'learning'}]},
+            {'competence': 'learning machine learning methods'},
+        ])
+        self.assertEqual(
+            getMatchingCompetence(taxonomy, 'Wer kennt sich mit Python aus?'),
+            ['python'])
+        self.assertEqual(
+            getMatchingCompetence(taxonomy, 'Hilfe bei Machine Learning und IT!'),
+            ['machine learning', 'learning', 'it'])
+        self.assertEqual(
+            getMatchingCompetence(taxonomy,
+                                  'learning machine learning methods'),
+            ['learning', 'machine learning', 'learning',
+             'learning machine learning methods'])
+        self.assertEqual(
+            getMatchingCompetence(taxonomy, 'deep. learning'), ['learning'])
+        self.assertEqual(searchCompetence('machine learning', taxonomy),
+                         ['machine learning'])
+
+    def test_getAllCompetences(self):
+        vocabulary = ['informatik', 'it', 'programmierung', 'python', 'django',
+                      'java', 'datenbanken', 'mysql', 'marketing', 'werbung']
+        self.assertEqual(getAllCompetences(COMPETENCES), vocabulary)
+        self.assertEqual(getAllCompetences(COMPETENCES), vocabulary)
+        self.assertEqual(
+            list(CompetenceTaxonomy(COMPETENCES).vocabulary), vocabulary)
+
+    def test_cachedStemmer(self):
+        cached = CachedStemmer(stemmer.stemmer, maxsize=2)
+        cached.warm(['Machine Learning'])
+        self.assertEqual(cached.stem('machine'), stemmer.stemmer.stem('machine'))
+        cached.stem('python') # evicts learning
+        cached.stem('learning')
+        self.assertEqual(cached.stats(), {'hits': 1, 'misses': 4, 'size': 2})
+
+    def test_competenceStore(self):
+        store = CompetenceStore(self.path)
+        self.write(COMPETENCES, 1000)
+        taxonomy = store.get()
+        self.assertIs(store.get(), taxonomy)
+        self.write(COMPETENCES[1:], 2000)
+        self.assertIsNot(store.get(), taxonomy)
+        self.assertEqual([c.competence for c in store.get()], ['marketing'])
+
+    def test_streamUserCompetenciesStopped(self):
+        cnx = FakeConnection(lambda query, data: [
+            (user_id, 'Anna', 'Meyer', 'Python, Java', None)
+            for user_id in range(4, 10)])
+        profiles = streamUserCompetencies(cnx, chunk_size=2)
+        self.assertEqual(next(profiles)[:2], (4, 'Anna Meyer'))
+        profiles.close()
+        self.assertEqual(cnx.cursors[-1].rows, [])
+        # the consumers error is not hidden by the unread rows
+        with self.assertRaises(KeyError):
+            for profile in streamUserCompetencies(cnx, chunk_size=2):
+                raise KeyError(profile[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
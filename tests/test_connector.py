@@ -0,0 +1,330 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+import unittest
+
+import mysql.connector
+
+import rasahub_humhub.humhub as humhub
+from rasahub.message import RasahubMessage
+from rasahub_humhub import HumhubConnector
+from rasahub_humhub.humhub import *
+from rasahub_humhub.humhub import queue
+
+
+class FakeCursor(object):
+    """
+    Cursor answering queries with the rows returned by the connection's
+    responder
+    """
+    def __init__(self, cnx, buffered=None):
+        self.cnx = cnx
+        self.buffered = buffered
+        self.rows = []
+        self.lastrowid = None
+        self.rowcount = -1
+
+    def execute(self, query, data=None):
+        self.cnx.queries.append((query, data))
+        self.rows = list(self.cnx.responder(query, data) or [])
+        self.lastrowid = getattr(self.cnx.responder, 'lastrowid', None)
+        self.rowcount = getattr(self.cnx.responder, 'rowcount',
+                                len(self.rows))
+
+    def executemany(self, query, rows):
+        self.execute(query, list(rows))
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        if self.buffered is False and self.rows:
+            raise mysql.connector.InternalError("Unread result found")
+
+
+class FakeConnection(object):
+    """
+    Connection recording all queries
+    """
+    def __init__(self, responder=None):
+        self.responder = responder or (lambda query, data: [])
+        self.queries = []
+        self.connected = True
+        self.reconnects = 0
+        self.transactions = []
+        self.cursors = []
+
+    def cursor(self, **kwargs):
+        self.cursors.append(FakeCursor(self, kwargs.get('buffered')))
+        return self.cursors[-1]
+
+    def consume_results(self):
+        for cursor in self.cursors:
+            cursor.rows = []
+
+    def is_connected(self):
+        return self.connected
+
+    def reconnect(self):
+        self.connected = True
+        self.reconnects += 1
+
+    def start_transaction(self):
+        self.transactions.append('start')
+
+    def commit(self):
+        self.transactions.append('commit')
+
+    def rollback(self):
+        self.transactions.append('rollback')
+
+    def close(self):
+        self.connected = False
+
+
+def humhubResponder(query, data):
+    """
+    Answers the queries a connector runs on startup
+    """
+    if query.startswith("SELECT MAX(id)"):
+        return [(7,)]
+    if "`group`.`name` = 'Bots'" in query:
+        return [(5,)]
+    return []
+
+
+class HumhubDB(object):
+    """
+    Message entries and bot memberships answering the connector's polling
+    queries
+    """
+    def __init__(self):
+        self.entries = []
+        self.memberships = set()
+
+    def __call__(self, query, data):
+        if query.startswith("SELECT id, message_id, user_id, content"):
+            return [entry for entry in self.entries
+                    if entry[0] > data['current_id'] and
+                    entry[2] != data['bot_id']][:data['limit']]
+        if query.startswith("SELECT message_id FROM user_message"):
+            return [(message_id,) for message_id in sorted(self.memberships)
+                    if len(data) == 1 or message_id in data[1:]]
+        return humhubResponder(query, data)
+
+    def add(self, message_id, user_id, content):
+        self.entries.append((len(self.entries) + 8, message_id, user_id,
+                             content))
+
+
+class WriteBehindBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.failures = 0
+        self.cnx = FakeConnection(self.respond)
+
+    def respond(self, query, data):
+        if self.failures > 0:
+            self.failures -= 1
+            raise mysql.connector.Error("Lost connection")
+        return []
+
+    def inserts(self):
+        return [rows for (query, rows) in self.cnx.queries
+                if query.startswith("INSERT INTO message_entry")]
+
+    def test_flushBySize(self):
+        buffer = WriteBehindBuffer(self.cnx, max_rows=2, flush_ms=60000)
+        buffer.add(1, 5, 'Eins')
+        self.assertEqual(self.inserts(), [])
+        buffer.add(2, 5, 'Zwei')
+        self.assertEqual(self.inserts(), [[(1, 5, 'Eins', 5, 5),
+                                           (2, 5, 'Zwei', 5, 5)]])
+        buffer.close()
+        self.assertEqual(len(self.inserts()), 1)
+
+    def test_flushByDeadline(self):
+        buffer = WriteBehindBuffer(self.cnx, max_rows=10, flush_ms=50)
+        buffer.add(1, 5, 'Eins')
+        buffer.add(1, 5, 'Zwei')
+        sleep(0.3)
+        self.assertEqual(self.inserts(), [[(1, 5, 'Eins', 5, 5),
+                                           (1, 5, 'Zwei', 5, 5)]])
+        buffer.close()
+
+    def test_flushOnClose(self):
+        buffer = WriteBehindBuffer(self.cnx, max_rows=10, flush_ms=60000)
+        buffer.add(1, 5, 'Eins')
+        buffer.close()
+        self.assertEqual(self.inserts(), [[(1, 5, 'Eins', 5, 5)]])
+        self.assertFalse(buffer.thread.is_alive())
+
+    def test_retryFailedFlush(self):
+        buffer = WriteBehindBuffer(self.cnx, max_rows=1, flush_ms=10)
+        buffer.retry_delay = 0.1
+        self.failures = 1
+        buffer.add(1, 5, 'Eins')
+        self.assertEqual(buffer.rows, [(1, 5, 'Eins', 5, 5)])
+        buffer.add(1, 5, 'Zwei') # no flush while failing
+        self.assertEqual(len(self.inserts()), 1)
+        sleep(0.4)
+        self.assertEqual(self.inserts()[-1], [(1, 5, 'Eins', 5, 5),
+                                              (1, 5, 'Zwei', 5, 5)])
+        self.assertEqual(buffer.rows, [])
+        buffer.close()
+
+
+class ConnectorTest(unittest.TestCase):
+    def setUp(self):
+        self.connections = []
+        self.responder = humhubResponder
+        self.connectToDB = humhub.connectToDB
+        humhub.connectToDB = self.connect
+
+    def tearDown(self):
+        humhub.connectToDB = self.connectToDB
+
+    def connect(self, *args):
+        cnx = FakeConnection(self.responder)
+        self.connections.append(cnx)
+        return cnx
+
+    def test_receiveJoinedConversation(self):
+        db = HumhubDB()
+        db.memberships.add(1)
+        self.responder = db
+        connector = HumhubConnector(poll_min_interval=0)
+        db.add(1, 2, 'Hallo')
+        db.add(2, 2, 'Nicht an den Bot')
+        self.assertEqual(connector.receive(),
+                         {'message': 'Hallo', 'message_id': 1})
+        self.assertIsNone(connector.receive())
+        db.memberships.add(2) # bot joins an existing conversation
+        db.add(2, 2, 'Jetzt mit Bot')
+        self.assertEqual(connector.receive(),
+                         {'message': 'Jetzt mit Bot', 'message_id': 2})
+        self.assertEqual(connector.conversations, set([1, 2]))
+        connector.end()
+
+    def test_receiveWaitsForPoll(self):
+        connector = HumhubConnector(poll_min_interval=0.1,
+                                    poll_max_interval=0.4)
+        calls = []
+        receive = connector.receive
+        connector.receive = lambda: calls.append(time()) or receive()
+        run_event = threading.Event()
+        thread = threading.Thread(target=connector.in_thread,
+                                  args=(queue.Queue(), run_event))
+        started = time()
+        thread.start()
+        sleep(1.5)
+        run_event.set()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertLess(time() - started, 2.5)
+        # polls at 0, 0.1, 0.3, 0.7 and 1.1 seconds
+        self.assertLessEqual(len(calls), 10)
+        self.assertGreaterEqual(connector.scheduler.polls, 4)
+        connector.end()
+
+    def test_poolMaxSize(self):
+        self.assertRaises(ValueError, HumhubConnector, pool_max_size=3)
+
+    def test_borrowedConnections(self):
+        db = HumhubDB()
+        db.memberships.add(1)
+        self.responder = db
+        connector = HumhubConnector(poll_min_interval=0, pool_max_size=2,
+                                    hold_connections=False)
+        self.assertIsNone(connector.cnx_in)
+        db.add(1, 2, 'Hallo')
+        self.assertEqual(connector.receive(),
+                         {'message': 'Hallo', 'message_id': 1})
+        connector.send(RasahubMessage(message = 'Antwort', message_id = 1,
+                                      target = 'humhub', source = 'rasa'),
+                       None)
+        # every call returned its connection
+        self.assertEqual(connector.pool.idle.qsize(), connector.pool.size)
+        self.assertEqual(len(self.connections), connector.pool.size)
+        connector.end()
+
+    def test_heldConnectionReconnect(self):
+        connector = HumhubConnector(poll_min_interval=0)
+        connector.pool.health_check_interval = 0
+        cursor = connector.cursor_in
+        self.assertIs(connector.checked_cursor(connector.cnx_in, cursor),
+                      cursor)
+        connector.cnx_in.connected = False
+        self.assertIsNot(connector.checked_cursor(connector.cnx_in, cursor),
+                         cursor)
+        self.assertEqual(connector.cnx_in.reconnects, 1)
+        connector.end()
+
+    def test_getSuggestions(self):
+        connector = HumhubConnector(poll_min_interval=0, suggestion_count=2)
+        calls = []
+
+        class CountingBackend(CalendarBackend):
+            def getBusyIntervals(self, users, datefrom, dateto, cursor):
+                calls.append(users)
+                return {}
+        connector.calendar_backend = CountingBackend()
+        args = {'datefrom': '2099-01-05T00:00:00.000Z',
+                'dateto': '2099-01-09T00:00:00.000Z',
+                'users': [2, 3]}
+        dates = []
+        for timesSearched in range(5):
+            args['timesSearched'] = timesSearched
+            dates.extend(connector.get_suggestions(
+                {'message_id': 1, 'args': args}, 60, None))
+        self.assertEqual(len(dates), 5)
+        self.assertEqual(dates, sorted(set(dates)))
+        # the first search and each search past the kept dates
+        self.assertEqual(len(calls), 3)
+        connector.end()
+
+    def test_getSuggestionsStale(self):
+        connector = HumhubConnector(poll_min_interval=0, suggestion_count=3)
+        calls = []
+
+        class CountingBackend(CalendarBackend):
+            def getBusyIntervals(self, users, datefrom, dateto, cursor):
+                calls.append(users)
+                return {}
+        connector.calendar_backend = CountingBackend()
+        args = {'datefrom': '2099-01-05T00:00:00.000Z',
+                'dateto': '2099-01-09T00:00:00.000Z',
+                'users': [2, 3],
+                'timesSearched': 0}
+        payload = {'message_id': 1, 'args': args}
+        first = connector.get_suggestions(payload, 60, None)
+        kept = list(connector.suggestions[1]['dates'])
+        self.assertEqual(first, kept[:1])
+        # the first date passed while the user was away
+        connector.suggestions[1]['dates'][0] = datetime.now() - timedelta(1)
+        args['timesSearched'] = 1
+        self.assertEqual(connector.get_suggestions(payload, 60, None),
+                         kept[1:2])
+        self.assertEqual(len(calls), 1)
+        connector.suggestions[1]['expires'] = 0
+        args['timesSearched'] = 2
+        connector.get_suggestions(payload, 60, None)
+        self.assertEqual(len(calls), 2)
+        connector.end()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -83,6 +83,61 @@ def handler(mysqld):
         PRIMARY KEY (`id`)
         ) DEFAULT CHARSET=utf8;""")
 
+    cursor.execute("""
+        CREATE TABLE `calendar_entry` (
+        `id` int(11) NOT NULL AUTO_INCREMENT,
+        `title` varchar(255) NOT NULL,
+        `start_datetime` datetime NOT NULL,
+        `end_datetime` datetime NOT NULL,
+        PRIMARY KEY (`id`)
+        ) DEFAULT CHARSET=utf8;""")
+
+    cursor.execute("""
+        CREATE TABLE `calendar_entry_participant` (
+        `id` int(11) NOT NULL AUTO_INCREMENT,
+        `calendar_entry_id` int(11) NOT NULL,
+        `user_id` int(11) NOT NULL,
+        `participation_state` tinyint(4) DEFAULT NULL,
+        PRIMARY KEY (`id`)
+        ) DEFAULT CHARSET=utf8;""")
+
+    cursor.execute("""
+        INSERT INTO `calendar_entry` (`id`, `title`, `start_datetime`, `end_datetime`) VALUES
+        (1,	'Termin',	'2018-05-24 08:00:00',	'2018-05-24 09:00:00'),
+        (2,	'Termin',	'2018-05-24 23:00:00',	'2018-05-25 01:00:00'),
+        (3,	'Termin',	'2018-05-28 10:00:00',	'2018-05-28 11:00:00');""")
+
+    cursor.execute("""
+        INSERT INTO `calendar_entry_participant` (`calendar_entry_id`, `user_id`, `participation_state`) VALUES
+        (1,	4,	3),
+        (2,	6,	3),
+        (3,	4,	3),
+        (2,	4,	1);""")
+
+    cursor.execute("""
+        CREATE TABLE `profile` (
+        `user_id` int(11) NOT NULL,
+        `firstname` varchar(20) DEFAULT NULL,
+        `lastname` varchar(30) DEFAULT NULL,
+        `competence` text DEFAULT NULL,
+        `updated_at` datetime DEFAULT NULL,
+        PRIMARY KEY (`user_id`)
+        ) DEFAULT CHARSET=utf8;""")
+
+    cursor.execute("""
+        INSERT INTO `profile` (`user_id`, `firstname`, `lastname`, `competence`, `updated_at`) VALUES
+        (4,	'Christian',	'Schmidt',	'Python, Java',	'2018-05-20 10:00:00'),
+        (5,	'Rasa',	'Bot',	NULL,	'2018-05-21 10:00:00'),
+        (6,	'Anna',	'Meyer',	'python,marketing',	'2018-05-22 10:00:00');""")
+
+    cursor.execute("""
+        CREATE TABLE `content` (
+        `id` int(11) NOT NULL AUTO_INCREMENT,
+        `guid` varchar(45) NOT NULL,
+        PRIMARY KEY (`id`),
+        UNIQUE KEY `index_guid` (`guid`)
+        ) DEFAULT CHARSET=utf8;""")
+
     cursor.executemany(
         """INSERT INTO `message_entry`
         (`message_id`, `user_id`, `content`, `created_at`, `created_by`, `updated_at`, `updated_by`)
@@ -166,6 +221,12 @@ class RasaHumhubTest(unittest.TestCase):
     def test_connection(self):
         self.assertIsNotNone(self.__class__.humhub.cnx_in)
 
+    def test_connectionPool(self):
+        pool = self.__class__.humhub.pool
+        with pool.connection() as cnx:
+            self.assertTrue(cnx.is_connected())
+        self.assertLessEqual(pool.size, pool.max_size)
+
     def test_userID(self):
         self.assertEqual(self.__class__.humhub.bot_id, 5)
 
@@ -184,6 +245,118 @@ class RasaHumhubTest(unittest.TestCase):
         sleep(3)
         self.assertEqual(self.__class__.humhub.current_id, 8)
 
+    def test_getBotConversations(self):
+        conn = mysql.connector.connect(**self.__class__.mysqld.dsn())
+        cursor = conn.cursor()
+        self.assertEqual(getBotConversations(cursor, 1), set([1]))
+        self.assertEqual(getBotConversations(cursor, 1, [1, 2]), set([1]))
+        self.assertEqual(getBotConversations(cursor, 1, [2]), set())
+        cursor.close()
+        conn.close()
+
+        self.assertEqual(self.__class__.humhub.conversations, set())
+
+    def test_pollScheduler(self):
+        scheduler = PollScheduler(1, 4)
+        scheduler.record(0, now=0)
+        self.assertFalse(scheduler.due(now=0.5))
+        self.assertTrue(scheduler.due(now=1))
+        scheduler.record(0, now=1)
+        scheduler.record(0, now=3)
+        scheduler.record(0, now=7)
+        self.assertEqual(scheduler.next_poll, 11)
+        self.assertEqual(scheduler.delay(now=8), 0.5)
+        self.assertAlmostEqual(scheduler.delay(now=10.75), 0.25)
+        scheduler.record(3, now=11)
+        self.assertTrue(scheduler.due(now=11))
+        self.assertEqual(scheduler.stats()['empty_polls'], 4)
+        self.assertEqual(scheduler.stats()['rows'], 3)
+
+    def test_humhubCalendarBackend(self):
+        conn = mysql.connector.connect(**self.__class__.mysqld.dsn())
+        cursor = conn.cursor()
+        calendars = HumhubCalendarBackend().getBusyIntervals(
+            [4, 6], datetime(2018, 5, 24, 7), datetime(2018, 5, 25, 19),
+            cursor)
+        cursor.close()
+        conn.close()
+
+        self.assertEqual(calendars[4][datetime(2018, 5, 24).date()],
+                         ((datetime(2018, 5, 24, 8), datetime(2018, 5, 24, 9)),))
+        self.assertEqual(calendars[4][datetime(2018, 5, 25).date()], ())
+        self.assertEqual(calendars[6][datetime(2018, 5, 25).date()],
+                         ((datetime(2018, 5, 25), datetime(2018, 5, 25, 1)),))
+
+    def test_profileDirectory(self):
+        conn = mysql.connector.connect(**self.__class__.mysqld.dsn())
+        directory = ProfileDirectory(maxsize=2, refresh_interval=0)
+        self.assertEqual(directory.getName(conn, 6), 'Anna Meyer')
+        self.assertEqual(sorted(directory.names), [5, 6])
+        self.assertEqual(directory.getID(conn, '', 'schmidt'), 4) # miss
+        self.assertEqual(directory.getID(conn, 'Anna', 'Meyer'), 6)
+        self.assertEqual(len(directory.names), 2)
+
+        cursor = conn.cursor()
+        cursor.execute("UPDATE profile SET lastname = 'Becker', "
+                       "updated_at = '2018-05-23 10:00:00' WHERE user_id = 6")
+        self.assertEqual(directory.getName(conn, 6), 'Anna Becker')
+        self.assertIsNone(directory.getID(conn, 'Anna', 'Meyer'))
+        self.assertIsNone(directory.getID(conn, '', 'Nobody'))
+        # saved in the same second as the last refresh
+        cursor.execute("UPDATE profile SET lastname = 'Wagner', "
+                       "updated_at = '2018-05-23 10:00:00' WHERE user_id = 6")
+        self.assertEqual(directory.getName(conn, 6), 'Anna Wagner')
+        cursor.close()
+        conn.rollback()
+        conn.close()
+
+    def test_competenceIndex(self):
+        conn = mysql.connector.connect(**self.__class__.mysqld.dsn())
+        index = CompetenceIndex(refresh_interval=0)
+        self.assertEqual(index.find(conn, ['python', 'informatik'], []),
+                         {'competence': 'python',
+                          'users': ['Christian Schmidt', 'Anna Meyer']})
+        self.assertEqual(index.find(conn, ['Java'], [4]), None)
+
+        cursor = conn.cursor()
+        cursor.execute("UPDATE profile SET competence = 'Java', "
+                       "updated_at = '2018-05-23 10:00:00' WHERE user_id = 6")
+        self.assertEqual(index.find(conn, ['Java'], [4]),
+                         {'competence': 'Java', 'users': ['Anna Meyer']})
+        self.assertNotIn('marketing', index.competences)
+        # saved in the same second as the last refresh
+        cursor.execute("UPDATE profile SET competence = 'Java, SQL', "
+                       "updated_at = '2018-05-23 10:00:00' WHERE user_id = 6")
+        self.assertEqual(index.find(conn, ['SQL'], [4]),
+                         {'competence': 'SQL', 'users': ['Anna Meyer']})
+        cursor.close()
+        conn.rollback()
+        conn.close()
+
+    def test_streamUserCompetencies(self):
+        conn = mysql.connector.connect(**self.__class__.mysqld.dsn())
+        profiles = streamUserCompetencies(conn, [6], chunk_size=1)
+        self.assertEqual(
+            [profile[:3] for profile in profiles],
+            [(4, 'Christian Schmidt', ('python', 'java'))])
+        profiles = streamUserCompetencies(
+            conn, since=datetime(2018, 5, 21), chunk_size=1)
+        self.assertEqual([profile[0] for profile in profiles], [5, 6])
+        conn.close()
+
+    def test_guidAllocator(self):
+        conn = mysql.connector.connect(**self.__class__.mysqld.dsn())
+        allocator = GUIDAllocator(batch_size=4)
+        guids = allocator.allocate(conn, 6)
+        conn.close()
+
+        self.assertEqual(len(set(guids)), 6)
+        for guid in guids:
+            self.assertIsNotNone(re.match(
+                '^[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}$',
+                guid))
+        self.assertEqual(len(allocator.guids), 0)
+
     def test_getNewDBMessage(self):
         self.assertEqual(self.__class__.test.message_out.message, 'Test')
 